@@ -0,0 +1,138 @@
+import sys
+from array import array
+
+# Per-repo counts live in one dict keyed by (row << REPO_BITS) | repo id
+REPO_BITS = 20
+
+
+class AuthorTable:
+    # Column store for per-author totals. Each author key is interned once and
+    # mapped to a row; times are epoch seconds and counts plain integers, kept
+    # in typed arrays instead of one boxed object per value per author.
+    #
+    # Per-repo commit and merge counts are kept too, so a repo that has to be
+    # walked again from scratch can take back what it added before, and the
+    # whole table round-trips through the state file as absolute counts.
+
+    def __init__(self):
+        self.rows = {}
+        self.keys = []
+        self.names = []
+        self.first = array("q")
+        self.last = array("q")
+        self.commits = array("q")
+        self.merges = array("q")
+        self.repo_ids = {}
+        self.repo_names = []
+        self.repo_counts = {}
+        self.repo_merges = {}
+        # Rows whose doc has to be rewritten after this run
+        self.touched = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, key, name=None):
+        row = self.rows.get(key)
+        if row is None:
+            key = sys.intern(key)
+            row = len(self.keys)
+            self.rows[key] = row
+            self.keys.append(key)
+            self.names.append(name)
+            self.first.append(sys.maxsize)
+            self.last.append(0)
+            self.commits.append(0)
+            self.merges.append(0)
+        elif self.names[row] is None:
+            self.names[row] = name
+        return row
+
+    def repo_id(self, repo_name):
+        repo_id = self.repo_ids.get(repo_name)
+        if repo_id is None:
+            repo_id = len(self.repo_names)
+            self.repo_ids[sys.intern(repo_name)] = repo_id
+            self.repo_names.append(repo_name)
+        return repo_id
+
+    def add_commit(self, key, name, repo_name, commit_time, is_merge):
+        # Returns (row, first commit time before this commit)
+        row = self.row(key, name)
+        previous_first = self.first[row]
+
+        self.commits[row] += 1
+        if is_merge:
+            self.merges[row] += 1
+        if commit_time < previous_first:
+            self.first[row] = commit_time
+        if commit_time > self.last[row]:
+            self.last[row] = commit_time
+
+        repo_key = (row << REPO_BITS) | self.repo_id(repo_name)
+        self.repo_counts[repo_key] = self.repo_counts.get(repo_key, 0) + 1
+        if is_merge:
+            self.repo_merges[repo_key] = self.repo_merges.get(repo_key, 0) + 1
+        self.touched.add(row)
+        return row, previous_first
+
+    def reset_repo(self, repo_name):
+        # Takes back every commit counted for the repo, before it is walked in
+        # full again. First/last times stay, they only ever widen.
+        repo_id = self.repo_ids.get(repo_name)
+        if repo_id is None:
+            return
+        mask = (1 << REPO_BITS) - 1
+        for repo_key in [repo_key for repo_key in self.repo_counts if repo_key & mask == repo_id]:
+            row = repo_key >> REPO_BITS
+            self.commits[row] -= self.repo_counts.pop(repo_key)
+            self.merges[row] -= self.repo_merges.pop(repo_key, 0)
+            self.touched.add(row)
+
+    def first_commit(self, key):
+        return self.first[self.rows[key]]
+
+    def load(self, state):
+        # Absolute counts from a previous run, as written by dump()
+        for key, (name, first, last, repos) in state.items():
+            row = self.row(key, name)
+            self.first[row] = first
+            self.last[row] = last
+            for repo_name, (commits, merges) in repos.items():
+                repo_key = (row << REPO_BITS) | self.repo_id(repo_name)
+                self.repo_counts[repo_key] = commits
+                if merges:
+                    self.repo_merges[repo_key] = merges
+                self.commits[row] += commits
+                self.merges[row] += merges
+
+    def dump(self):
+        # {key: [name, first, last, {repo name: [commits, merges]}]}
+        state = {key: [self.names[row], self.first[row], self.last[row], {}] for row, key in enumerate(self.keys)}
+        mask = (1 << REPO_BITS) - 1
+        for repo_key, count in self.repo_counts.items():
+            state[self.keys[repo_key >> REPO_BITS]][3][self.repo_names[repo_key & mask]] = [
+                count, self.repo_merges.get(repo_key, 0)
+            ]
+        return state
+
+    def repos_by_row(self):
+        # {row: {repo name: count}}, built once when the aggregates are written
+        repos = {}
+        mask = (1 << REPO_BITS) - 1
+        for repo_key, count in self.repo_counts.items():
+            repos.setdefault(repo_key >> REPO_BITS, {})[self.repo_names[repo_key & mask]] = count
+        return repos
+
+    def memory_footprint(self):
+        # Bytes held by the table itself, keys and names included
+        size = sys.getsizeof(self.rows) + sys.getsizeof(self.keys) + sys.getsizeof(self.names)
+        size += sum(sys.getsizeof(key) for key in self.keys)
+        size += sum(sys.getsizeof(name) for name in self.names if name is not None)
+        size += sum(sys.getsizeof(column) for column in (self.first, self.last, self.commits, self.merges))
+        size += sys.getsizeof(self.repo_ids) + sys.getsizeof(self.repo_names)
+        size += sum(sys.getsizeof(repo_name) for repo_name in self.repo_names)
+        for counts in (self.repo_counts, self.repo_merges):
+            size += sys.getsizeof(counts)
+            size += sum(sys.getsizeof(repo_key) + sys.getsizeof(count) for repo_key, count in counts.items())
+        return size
@@ -0,0 +1,97 @@
+# Compares peak RSS of the per-author dicts repoagg used to keep against
+# AuthorTable on a synthetic stream of commits. Each mode runs in its own
+# process so their peaks don't mix.
+#
+#   python bench_authors.py --commits 1000000 --authors 200000
+import argparse
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from authortable import AuthorTable
+
+
+def synthetic_commits(commits, authors, repos, seed):
+    # Fresh strings per commit, like records coming back from extraction
+    rng = random.Random(seed)
+    for i in range(commits):
+        # Skewed towards a core of frequent committers with a long tail
+        author = int(authors * rng.random() ** 3)
+        yield (
+            "contributor%d@example.com" % author,
+            "Contributor %d" % author,
+            "repos/repo-%d" % rng.randrange(repos),
+            1400000000 + rng.randrange(300000000),
+            i % 50 == 0
+        )
+
+
+def run_dicts(commits):
+    commit_authors = {}
+    authors_first_commit = {}
+    authors_last_commit = {}
+    author_names = {}
+    author_repos = {}
+    author_merges = {}
+    for email, name, repo_name, commit_time, is_merge in commits:
+        if email not in commit_authors:
+            commit_authors[email] = 0
+            author_names[email] = name
+            author_repos[email] = {}
+            author_merges[email] = 0
+            authors_last_commit[email] = commit_time
+            authors_first_commit[email] = commit_time
+        commit_authors[email] += 1
+        author_repos[email][repo_name] = author_repos[email].get(repo_name, 0) + 1
+        if is_merge:
+            author_merges[email] += 1
+        if authors_last_commit[email] < commit_time:
+            authors_last_commit[email] = commit_time
+        if authors_first_commit[email] > commit_time:
+            authors_first_commit[email] = commit_time
+    return len(commit_authors)
+
+
+def run_table(commits):
+    table = AuthorTable()
+    for email, name, repo_name, commit_time, is_merge in commits:
+        table.add_commit(email, name, repo_name, commit_time, is_merge)
+    print("  AuthorTable.memory_footprint(): %.1f MiB" % (table.memory_footprint() / 1024 / 1024))
+    return len(table)
+
+
+def peak_rss_mib():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(args):
+    baseline = peak_rss_mib()
+    start = time.perf_counter()
+    commits = synthetic_commits(args.commits, args.authors, args.repos, args.seed)
+    count = run_dicts(commits) if args.mode == "dicts" else run_table(commits)
+    elapsed = time.perf_counter() - start
+    print("%-6s %d authors in %.2fs, peak RSS +%.1f MiB" % (args.mode, count, elapsed, peak_rss_mib() - baseline))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark memory use of repoagg author tracking")
+    parser.add_argument("--commits", type=int, default=1000000)
+    parser.add_argument("--authors", type=int, default=200000)
+    parser.add_argument("--repos", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--mode", choices=["dicts", "table"], default=None)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args)
+        return
+
+    for mode in ["dicts", "table"]:
+        subprocess.run([sys.executable, __file__, "--mode", mode] + sys.argv[1:], check=True)
+
+
+if __name__ == "__main__":
+    main()
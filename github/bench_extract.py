@@ -0,0 +1,83 @@
+# Compares the GitPython and `git log` commit extractors in repoagg.py on a
+# synthetic repo with a long history.
+#
+#   python bench_extract.py --commits 50000
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from repoagg import EXTRACTORS
+
+
+def fast_import_stream(commits, authors):
+    # Linear history with a merge every 100 commits and a few timezones, fed
+    # to `git fast-import` so building the repo doesn't dominate the benchmark
+    lines = []
+    for i in range(1, commits + 1):
+        author = i % authors
+        tz = ["+0000", "-0700", "+0530", "+0100"][i % 4]
+        message = "Commit %d\n\nSome longer body text for commit %d.\n" % (i, i)
+        if i % 100 == 0:
+            message = "Merge pull request #%d from hackclub/feature-%d\n" % (i, i)
+        data = message.encode()
+        lines.append(b"commit refs/heads/main")
+        lines.append(b"mark :%d" % i)
+        lines.append(("author Author %d <author%d@example.com> %d %s" % (author, author, 1500000000 + i * 60, tz)).encode())
+        lines.append(("committer Committer <committer@example.com> %d +0000" % (1500000000 + i * 60 + 30)).encode())
+        lines.append(b"data %d" % len(data))
+        lines.append(data)
+        if i > 1:
+            lines.append(b"from :%d" % (i - 1))
+        if i % 100 == 0 and i > 2:
+            lines.append(b"merge :%d" % (i - 2))
+        lines.append(b"")
+    return b"\n".join(lines) + b"\n"
+
+
+def make_repo(path, commits, authors):
+    subprocess.run(["git", "init", "-q", "-b", "main", path], check=True)
+    subprocess.run(
+        ["git", "-C", path, "fast-import", "--quiet"],
+        input=fast_import_stream(commits, authors),
+        check=True
+    )
+    subprocess.run(["git", "-C", path, "checkout", "-q", "main"], check=True)
+
+
+def time_backend(backend, repo_name):
+    start = time.perf_counter()
+    records = list(EXTRACTORS[backend](repo_name))
+    return time.perf_counter() - start, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark repoagg commit extraction backends")
+    parser.add_argument("--commits", type=int, default=50000)
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        repo_name = os.path.join(tmp, "synthetic")
+        print("Building synthetic repo with " + str(args.commits) + " commits...")
+        make_repo(repo_name, args.commits, args.authors)
+
+        results = {}
+        for backend in sorted(EXTRACTORS.keys()):
+            best = None
+            for _ in range(args.rounds):
+                elapsed, records = time_backend(backend, repo_name)
+                best = elapsed if best is None else min(best, elapsed)
+            results[backend] = records
+            print("%-10s %8d commits  %7.3fs  %9.0f commits/s" % (backend, len(records), best, len(records) / best))
+
+        if results["gitpython"] == results["git-log"]:
+            print("Backends produced identical records")
+        else:
+            print("WARNING: backends produced different records")
+
+
+if __name__ == "__main__":
+    main()
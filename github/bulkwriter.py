@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+
+def json_default(obj):
+    # Matches what the elasticsearch client does with dates
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    raise TypeError("Unable to serialize " + repr(obj))
+
+
+def serialize(obj):
+    return json.dumps(obj, default=json_default, ensure_ascii=False).encode("utf-8")
+
+
+class BulkWriter:
+    # Buffers bulk actions as pre-serialized NDJSON and sends them with
+    # client.bulk() once either the document count or the byte size limit is
+    # hit. Items rejected with 429, and whole requests that hit a connection
+    # error or timeout (`retry_on`, plus the builtin ones), are retried with
+    # exponential backoff; every other failure is counted. `client` only needs
+    # a bulk(index=, operations=) method, so a stub can stand in for
+    # Elasticsearch.
+    #
+    # With in_flight > 0 flushes are handed to a thread pool so extraction
+    # keeps going while up to in_flight bulk requests are on the wire. Once
+    # that many are outstanding the next flush blocks until one finishes,
+    # which holds back the producer instead of buffering without bound.
+
+    def __init__(self, client, index, max_docs=500, max_bytes=5 * 1024 * 1024, max_retries=5, backoff=0.5, in_flight=0, retry_on=()):
+        self.client = client
+        self.retry_on = (ConnectionError, TimeoutError) + tuple(retry_on)
+        self.index = index
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.items = []
+        self.size = 0
+
+        self.executor = None
+        if in_flight > 0:
+            self.executor = ThreadPoolExecutor(max_workers=in_flight, thread_name_prefix="bulk")
+            self.slots = threading.BoundedSemaphore(in_flight)
+
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.total_docs = 0
+        self.total_bytes = 0
+        self.total_errors = 0
+        self.total_retries = 0
+        self.total_seconds = 0.0
+        self.total_waiting = 0.0
+
+    def add(self, action, source):
+        item = serialize(action) + b"\n" + serialize(source) + b"\n"
+        self.items.append(item)
+        self.size += len(item)
+
+        if len(self.items) >= self.max_docs or self.size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+
+        items, size = self.items, self.size
+        self.items, self.size = [], 0
+
+        if self.executor is None:
+            self.write(items, size)
+            return
+
+        # Backpressure: wait for a free slot before queueing another request
+        start = time.perf_counter()
+        self.slots.acquire()
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.total_waiting += waited
+
+        future = self.executor.submit(self.write, items, size)
+        future.add_done_callback(self.release)
+
+    def release(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            print("Bulk writer thread failed: " + str(future.exception()))
+
+    def write(self, items, size):
+        start = time.perf_counter()
+        docs = len(items)
+        errors = 0
+        retries = 0
+        attempt = 0
+        while items:
+            try:
+                rejected, failed = self.send(items)
+            except Exception as error:
+                # A malformed response must not lose the batch without a trace,
+                # or the run would look clean and save its state
+                print("Bulk writer failed: %s: %s" % (type(error).__name__, error))
+                errors += len(items)
+                break
+            errors += failed
+            if rejected and attempt < self.max_retries:
+                attempt += 1
+                retries += len(rejected)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                items = rejected
+            else:
+                errors += len(rejected)
+                items = []
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            self.total_docs += docs
+            self.total_bytes += size
+            self.total_errors += errors
+            self.total_retries += retries
+            self.total_seconds += elapsed
+
+        print(
+            "Bulk upload chunk: %d docs, %.1f KiB in %.2fs (%.0f docs/s), %d retried, %d errors"
+            % (docs, size / 1024, elapsed, docs / elapsed if elapsed > 0 else 0, retries, errors)
+        )
+
+    def send(self, items):
+        # Returns (items to retry, number of items that failed for good)
+        try:
+            response = self.client.bulk(index=self.index, operations=b"".join(items))
+        except Exception as error:
+            if getattr(error, "status_code", None) == 429 or isinstance(error, self.retry_on):
+                print("Bulk request failed, retrying: " + str(error))
+                return items, 0
+            print("Bulk request failed: " + str(error))
+            return [], len(items)
+
+        if not response["errors"]:
+            return [], 0
+
+        rejected = []
+        failed = 0
+        for item, result in zip(items, response["items"]):
+            status = next(iter(result.values()))
+            if status.get("status") == 429:
+                rejected.append(item)
+            elif "error" in status:
+                failed += 1
+                if failed <= 3:
+                    print("Bulk item failed: " + json.dumps(status["error"]))
+        return rejected, failed
+
+    def close(self):
+        # Flush what is left and wait for every in-flight request
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def report(self):
+        rate = self.total_docs / self.total_seconds if self.total_seconds > 0 else 0
+        print(
+            "Bulk upload total: %d docs, %.1f MiB in %.2fs of requests (%.0f docs/s), %d retried, %d errors"
+            % (self.total_docs, self.total_bytes / 1024 / 1024, self.total_seconds, rate, self.total_retries, self.total_errors)
+        )
+
+        wall = time.perf_counter() - self.started
+        print(
+            "End to end: %d docs in %.2fs (%.0f docs/s), %.2fs spent waiting on in-flight requests"
+            % (self.total_docs, wall, self.total_docs / wall if wall > 0 else 0, self.total_waiting)
+        )
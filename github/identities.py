@@ -0,0 +1,119 @@
+import re
+import subprocess
+
+# 12345+login@users.noreply.github.com and login@users.noreply.github.com are the same account
+NOREPLY_RE = re.compile(r"^(?:\d+\+)?([^@]+)@users\.noreply\.github\.com$")
+
+# Proper Name <proper@email> Commit Name <commit@email>, every part but the first email optional
+MAILMAP_RE = re.compile(r"^\s*([^<#]*?)\s*<([^>]*)>\s*(?:([^<#]*?)\s*<([^>]*)>)?\s*(?:#.*)?$")
+
+
+def normalize_email(email):
+    email = email.strip().lower()
+    match = NOREPLY_RE.match(email)
+    if match:
+        return match.group(1) + "@users.noreply.github.com"
+    return email
+
+
+class UnionFind:
+    # Disjoint sets over email strings with path halving and union by size, so
+    # merging N identities costs ~O(N) instead of comparing every pair. Each set
+    # also tracks its best member, which becomes the canonical key.
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+        self.best = {}
+        self.preferred = set()
+
+    def rank(self, email):
+        # Addresses named as the proper address in a mailmap win, then real
+        # addresses over noreply ones, then alphabetical order for determinism
+        return (email not in self.preferred, email.endswith("@users.noreply.github.com"), email)
+
+    def add(self, email):
+        if email not in self.parent:
+            self.parent[email] = email
+            self.size[email] = 1
+            self.best[email] = email
+
+    def find(self, email):
+        self.add(email)
+        parent = self.parent
+        while parent[email] != email:
+            parent[email] = parent[parent[email]]
+            email = parent[email]
+        return email
+
+    def union(self, a, b):
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size.pop(root_b)
+        self.best[root_a] = min(self.best[root_a], self.best.pop(root_b), key=self.rank)
+        return root_a
+
+    def prefer(self, email):
+        root = self.find(email)
+        self.preferred.add(email)
+        self.best[root] = min(self.best[root], email, key=self.rank)
+
+    def canonical(self, email):
+        return self.best[self.find(email)]
+
+
+class IdentityResolver:
+    # Maps raw commit emails onto one key per person, using .mailmap files and
+    # an optional org-wide file in the same format. Every mapping is treated as
+    # global: once two addresses are known to be the same person they are
+    # merged everywhere, not just in the repo whose mailmap said so. Entries
+    # that also match on commit name are applied by email alone.
+
+    def __init__(self):
+        self.sets = UnionFind()
+        self.names = {}
+        self.cache = {}
+
+    def load_mailmap(self, text):
+        for line in text.splitlines():
+            match = MAILMAP_RE.match(line)
+            if not match:
+                continue
+            proper_name, proper_email, _, commit_email = match.groups()
+            proper_email = normalize_email(proper_email)
+            if proper_name:
+                self.names[proper_email] = proper_name
+            if commit_email:
+                self.sets.union(proper_email, normalize_email(commit_email))
+            self.sets.prefer(proper_email)
+        self.cache.clear()
+
+    def load_mailmap_file(self, path):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            self.load_mailmap(f.read())
+
+    def load_repo_mailmap(self, repo_name):
+        # Read from the HEAD tree so this also works for bare and partial clones
+        result = subprocess.run(
+            ["git", "-C", repo_name, "show", "HEAD:.mailmap"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        if result.returncode == 0:
+            self.load_mailmap(result.stdout.decode("utf-8", "replace"))
+
+    def resolve(self, email):
+        # Memoised since the same handful of addresses show up over and over
+        key = self.cache.get(email)
+        if key is None:
+            key = self.sets.canonical(normalize_email(email))
+            self.cache[email] = key
+        return key
+
+    def name(self, key, fallback):
+        return self.names.get(key, fallback)
@@ -0,0 +1,98 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Same listing ghguzzle.sh does, names only
+ORG_REPOS_QUERY = """
+query($endCursor: String, $organization: String!) {
+  organization(login: $organization) {
+    repositories (first:25, after: $endCursor) {
+      pageInfo {
+        endCursor
+        hasNextPage
+      }
+      edges {
+        node {
+          name
+        }
+      }
+    }
+  }
+}"""
+
+# Only branches are mirrored; GitHub's refs/pull/* would drag in every PR head
+BRANCHES_REFSPEC = "+refs/heads/*:refs/heads/*"
+
+
+def git(*args):
+    return subprocess.run(["git"] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def org_repo_urls(org):
+    result = subprocess.run(
+        [
+            "gh", "api", "graphql", "--paginate",
+            "-F", "organization=" + org,
+            "-q", ".data.organization.repositories.edges[].node.name",
+            "-f", "query=" + ORG_REPOS_QUERY
+        ],
+        stdout=subprocess.PIPE,
+        check=True
+    )
+    names = sorted(result.stdout.decode().split())
+    return ["git@github.com:" + org + "/" + name + ".git" for name in names]
+
+
+def read_repo_urls(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def mirror_name(url):
+    name = url.rstrip("/").split("/")[-1].split(":")[-1]
+    return name[:-len(".git")] if name.endswith(".git") else name
+
+
+def is_bare(path):
+    result = git("-C", path, "rev-parse", "--is-bare-repository")
+    return result.returncode == 0 and result.stdout.decode().strip() == "true"
+
+
+def sync_mirror(url, path):
+    # Blobless bare mirror: commits and trees only, which is all repoagg reads.
+    # Blobs (e.g. .mailmap) are fetched on demand if something asks for them.
+    if not os.path.exists(path):
+        result = git("clone", "--bare", "--filter=blob:none", "--quiet", url, path)
+        action = "Cloned"
+    elif is_bare(path):
+        result = git("-C", path, "fetch", "--prune", "--quiet", "origin", BRANCHES_REFSPEC)
+        action = "Fetched"
+    else:
+        # A working-tree clone made by ghguzzle.sh; leave it to that script
+        return "Skipped " + path + ": not a mirror managed by repoagg"
+
+    if result.returncode != 0:
+        return "Failed to sync " + path + ": " + result.stderr.decode().strip()
+
+    write_commit_graph(path)
+    return action + " " + path
+
+
+def write_commit_graph(path):
+    # Lets history walks read commit metadata from the graph file instead of
+    # inflating every commit object. --split only appends the new commits.
+    git("-C", path, "config", "fetch.writeCommitGraph", "true")
+    result = git("-C", path, "commit-graph", "write", "--reachable", "--split")
+    if result.returncode != 0:
+        print("Could not write commit-graph for " + path + ": " + result.stderr.decode().strip())
+
+
+def sync_mirrors(urls, directory, jobs=1):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    paths = [os.path.join(directory, mirror_name(url)) for url in urls]
+    # Fetches are network bound, so threads are enough to overlap them
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for message in pool.map(sync_mirror, urls, paths):
+            print(message)
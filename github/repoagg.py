@@ -1,6 +1,18 @@
 from git import Repo
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from multiprocessing import Pool
+import argparse
+import json
 import os
-from elasticsearch import Elasticsearch
+import subprocess
+import sys
+from elasticsearch import Elasticsearch, NotFoundError, ConnectionError as ESConnectionError, ConnectionTimeout
+from authortable import AuthorTable
+from bulkwriter import BulkWriter
+from identities import IdentityResolver
+from mirrors import org_repo_urls, read_repo_urls, sync_mirrors
 
 # TODO don't hardcode this
 directory = 'repos'
@@ -14,39 +26,86 @@ es = Elasticsearch(
     verify_certs=False
 )
 
-try:
-    es.indices.delete(index="search-github-contributors")
-    print("Deleted old index...")
-except Exception as error:
-    print(error)
+# Dashboards query the aliases; each full rebuild gets its own concrete indices
+INDEX_ALIAS = "search-github-contributors"
+target_index = INDEX_ALIAS
 
-print("Creating new index...")
-es.indices.create(index="search-github-contributors", ignore=400)
+# One precomputed doc per author, so dashboards don't aggregate over every commit
+AUTHORS_ALIAS = "github-contributors-authors"
+authors_index = AUTHORS_ALIAS
+AUTHORS_MAPPINGS = {
+    "properties": {
+        "email": {"type": "keyword"},
+        "name": {"type": "keyword"},
+        "total_commits": {"type": "long"},
+        "merge_commits": {"type": "long"},
+        # repo -> commit count; flattened so new repos don't add mapped fields
+        "repos": {"type": "flattened"},
+        "first_contribution_date": {"type": "date"},
+        "last_contribution_date": {"type": "date"}
+    }
+}
 
+# Authors are keyed on a canonical identity rather than the raw commit email
+identities = IdentityResolver()
 
-# iterate over files in
-# that directory
-def bulk_actions_for_commit(repo_name, commit, first_commit_times):
+# Compact, picklable view of a commit. Workers send these back instead of
+# GitPython objects, and everything downstream only ever looks at these fields.
+CommitRecord = namedtuple('CommitRecord', [
+    'sha',
+    'email',
+    'name',
+    'authored_date',
+    'author_tz_offset',
+    'committed_date',
+    'message',
+    'is_merge'
+])
+
+
+def commit_record(commit):
+    return CommitRecord(
+        commit.hexsha,
+        commit.author.email,
+        commit.author.name,
+        commit.authored_date,
+        commit.author_tz_offset,
+        commit.committed_date,
+        commit.message,
+        len(commit.parents) > 1
+    )
+
+
+def authored_datetime(record):
+    # author_tz_offset is in seconds west of UTC, same as GitPython
+    return datetime.fromtimestamp(record.authored_date, timezone(timedelta(seconds=-record.author_tz_offset)))
+
+
+def first_contribution_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def bulk_actions_for_commit(repo_name, record, author_table):
     commit_actions = []
-    email = commit.author.email
-    name = commit.author.name
     try:
-        message = commit.message
+        author = identities.resolve(record.email)
+        message = record.message
         is_pr_commit = "Merge pull request" in message
         commit_doc = {
             "index": {
-                "_index": "search-github-contributors",
-                "_id": commit.hexsha
+                "_index": target_index,
+                "_id": record.sha
             }
         }
         commit_actions.append(commit_doc)
         commit_actions.append(
             {
-                "email": email,
-                "name": name,
+                "email": record.email,
+                "author": author,
+                "name": record.name,
                 "repo": repo_name,
-                "date": commit.authored_datetime,
-                "first_contribution_date": first_commit_times[email],
+                "date": authored_datetime(record),
+                "first_contribution_date": first_contribution_datetime(author_table.first_commit(author)),
                 "message": message,
                 "is_assistive": is_pr_commit
             }
@@ -57,69 +116,502 @@ def bulk_actions_for_commit(repo_name, commit, first_commit_times):
     return commit_actions
 
 
-def on_all_commits(commit_callback):
-    for filename in os.listdir(directory):
+def repo_names():
+    # Sorted so serial and parallel runs see repos in the same order
+    for filename in sorted(os.listdir(directory)):
         repo_name = os.path.join(directory, filename)
-        # checking if it is a file
-        all_commits_in_repo(repo_name, commit_callback)
+        if os.path.isdir(repo_name):
+            yield repo_name
+
+
+def resolve_head(repo_name):
+    result = subprocess.run(
+        ["git", "-C", repo_name, "rev-parse", "--verify", "--quiet", "HEAD"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode().strip()
+
+
+def is_ancestor(repo_name, old, new):
+    result = subprocess.run(
+        ["git", "-C", repo_name, "merge-base", "--is-ancestor", old, new],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+
+def count_commits(repo_name, rev):
+    result = subprocess.run(
+        ["git", "-C", repo_name, "rev-list", "--count", rev],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    if result.returncode != 0:
+        return None
+    return int(result.stdout)
+
+
+def repo_tasks(indexed_heads):
+    # (repo, head, rev) for every repo with something new to index. Repos whose
+    # previous head is no longer in their history (force pushes), or with more
+    # new commits than one walk reads, are walked in full; main() deletes their
+    # docs and takes back their earlier author counts before they are added again.
+    for repo_name in repo_names():
+        head = resolve_head(repo_name)
+        if head is None:
+            print("Skipping " + repo_name + ": no HEAD")
+            continue
+
+        old = indexed_heads.get(repo_name)
+        if old == head:
+            continue
+        if old is not None and is_ancestor(repo_name, old, head):
+            count = count_commits(repo_name, old + ".." + head)
+            if count is not None and count <= MAX_COMMITS:
+                yield repo_name, head, old + ".." + head
+                continue
+            print("Re-indexing " + repo_name + " in full: too many new commits since the last run")
+        yield repo_name, head, head
+
+
+# Most commits read from one repo in one walk
+MAX_COMMITS = 50000
+
+
+# Extractors are generators of CommitRecords that return whether they read all
+# of `rev`; a repo that failed part way must not be marked as indexed
+def commits_in_repo(repo_name, rev="HEAD"):
+    try:
+        repo = Repo(repo_name)
+        # Stream commits straight from git rather than materialising the whole history
+        for commit in repo.iter_commits(rev, max_count=MAX_COMMITS):
+            yield commit_record(commit)
+    except Exception as error:
+        print("Skipping " + repo_name + ": " + str(error))
+        return False
+    return True
+
+
+# One NUL-separated field per CommitRecord column; -z also puts a NUL between commits
+GIT_LOG_FORMAT = "%H%x00%ae%x00%an%x00%ad%x00%ct%x00%P%x00%B"
+GIT_LOG_FIELDS = 7
+
+
+def parse_raw_date(raw):
+    # --date=raw gives "<epoch> <+/-hhmm>", turn the zone into seconds west of UTC
+    timestamp, tz = raw.split(" ")
+    sign = -1 if tz[0] == "-" else 1
+    offset = sign * (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60)
+    return int(timestamp), -offset
+
+
+def record_from_git_log(fields):
+    sha, email, name, authored, committed, parents, message = [field.decode("utf-8", "replace") for field in fields]
+    authored_date, author_tz_offset = parse_raw_date(authored)
+    return CommitRecord(
+        sha,
+        email,
+        name,
+        authored_date,
+        author_tz_offset,
+        int(committed),
+        message,
+        len(parents.split()) > 1
+    )
+
+
+def commits_in_repo_git_log(repo_name, rev="HEAD"):
+    # Same records as commits_in_repo, but from a single `git log` process per
+    # repo instead of one GitPython object (and object parse) per commit
+    try:
+        process = subprocess.Popen(
+            [
+                "git", "-C", repo_name, "log", "-z", "--date=raw",
+                "--max-count=" + str(MAX_COMMITS), "--format=" + GIT_LOG_FORMAT, rev
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except Exception as error:
+        print("Skipping " + repo_name + ": " + str(error))
+        return False
+
+    fields = []
+    pending = b""
+    try:
+        for chunk in iter(partial(process.stdout.read, 65536), b""):
+            parts = (pending + chunk).split(b"\0")
+            pending = parts.pop()
+            for part in parts:
+                fields.append(part)
+                if len(fields) == GIT_LOG_FIELDS:
+                    yield record_from_git_log(fields)
+                    fields = []
+        # Whatever is left over is the message of the last commit
+        if fields:
+            fields.append(pending)
+        if len(fields) == GIT_LOG_FIELDS:
+            yield record_from_git_log(fields)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if process.returncode != 0:
+        print("Skipping " + repo_name + ": git log exited with " + str(process.returncode))
+        return False
+    return True
+
+
+EXTRACTORS = {
+    "gitpython": commits_in_repo,
+    "git-log": commits_in_repo_git_log
+}
+
 
+def extract_repo(backend, task):
+    # Runs inside a worker process, so hand back plain tuples for pickling
+    repo_name, head, rev = task
+    records = []
+    extracted = run_callback(lambda _, record: records.append(record), repo_name, EXTRACTORS[backend](repo_name, rev))
+    return repo_name, head, records, extracted
 
-def all_commits_in_repo(repo_name, commit_callback):
-    if os.path.isdir(repo_name):
+
+def mark_indexed(repo_name, head, extracted):
+    if extracted:
+        indexed_heads[repo_name] = head
+    else:
+        # Whatever it did index gets walked again, in full, next run
+        indexed_heads.pop(repo_name, None)
+
+
+def on_all_commits(commit_callback, tasks, workers=1, backend="gitpython"):
+    if workers > 1:
+        with Pool(workers) as pool:
+            # imap keeps results in repo order, so the output matches the serial path
+            for repo_name, head, records, extracted in pool.imap(partial(extract_repo, backend), tasks):
+                run_callback(commit_callback, repo_name, records)
+                mark_indexed(repo_name, head, extracted)
+    else:
+        for repo_name, head, rev in tasks:
+            extracted = run_callback(commit_callback, repo_name, EXTRACTORS[backend](repo_name, rev))
+            mark_indexed(repo_name, head, extracted)
+
+
+def run_callback(commit_callback, repo_name, records):
+    # Returns what an extractor returns once exhausted, None for a plain list
+    records = iter(records)
+    while True:
+        try:
+            record = next(records)
+        except StopIteration as stop:
+            return stop.value
         try:
-            repo = Repo(repo_name)
-            for commit in list(repo.iter_commits(repo.active_branch, max_count=50000)):
-                try:
-                    commit_callback(repo_name, commit)
-                except Exception as error:
-                    print("Error in commit callback: " + error)
-                    pass
-        except:
+            commit_callback(repo_name, record)
+        except Exception as error:
+            print("Error in commit callback: " + str(error))
             pass
 
 
-commit_authors = {}
-bulk_actions = []
-authors_first_commit = {}
+writer = None
+authors = AuthorTable()
+# Authors whose first commit moved earlier after some of their docs were written
+changed_first_commit = set()
+indexed_heads = {}
+
+def track_author(repo_name, record):
+    # Keep track of all authors, their counts and first/last commit times
+    email = identities.resolve(record.email)
+    commit_time = record.committed_date
+    _, time_prev = authors.add_commit(
+        email,
+        identities.name(email, record.name),
+        repo_name,
+        commit_time,
+        record.is_merge
+    )
+
+    if time_prev != sys.maxsize and time_prev > commit_time:
+        changed_first_commit.add(email)
+
+
+def index(repo_name, record):
+    track_author(repo_name, record)
+
+    # Buffer bulk upload records, the writer uploads when appropriate
+    actions = bulk_actions_for_commit(repo_name, record, authors)
+    for i in range(0, len(actions), 2):
+        writer.add(actions[i], actions[i + 1])
+
+
+# Authors per update_by_query request when backfilling first_contribution_date
+FIRST_CONTRIBUTION_CHUNK = 500
+
+def apply_first_contribution_dates(emails):
+    # Docs are written with the earliest commit seen so far; authors whose
+    # first commit turned out to be even earlier get patched afterwards
+    es.indices.refresh(index=target_index)
+
+    emails = sorted(emails)
+    for i in range(0, len(emails), FIRST_CONTRIBUTION_CHUNK):
+        chunk = emails[i:i + FIRST_CONTRIBUTION_CHUNK]
+        first = {email: first_contribution_datetime(authors.first_commit(email)) for email in chunk}
+        es.update_by_query(
+            index=target_index,
+            query={"terms": {"author.keyword": chunk}},
+            script={
+                "source": "ctx._source.first_contribution_date = params.first[ctx._source.author]",
+                "params": {"first": first}
+            },
+            conflicts="proceed",
+            slices="auto",
+            refresh=True
+        )
+        print("Applied first contribution dates for " + str(i + len(chunk)) + "/" + str(len(emails)) + " authors")
+
+
+def delete_repo_docs(repo_name):
+    # A full re-walk only rewrites the commits still in the repo's history;
+    # ones dropped by a force push would stay in the index otherwise
+    es.indices.refresh(index=target_index)
+    response = es.delete_by_query(
+        index=target_index,
+        query={"term": {"repo.keyword": repo_name}},
+        conflicts="proceed",
+        refresh=True
+    )
+    print("Deleted " + str(response["deleted"]) + " docs of " + repo_name + " before walking it in full")
+
+
+def author_doc(row, repos):
+    return {
+        "email": authors.keys[row],
+        "name": authors.names[row],
+        "total_commits": authors.commits[row],
+        "merge_commits": authors.merges[row],
+        "repos": repos,
+        "first_contribution_date": first_contribution_datetime(authors.first[row]).isoformat(),
+        "last_contribution_date": first_contribution_datetime(authors.last[row]).isoformat()
+    }
 
-def preprocess(repo_name, commit):
-    # Keep track of all authors
-    email = commit.author.email
-    commit_time = commit.committed_datetime
 
-    # Index commit authors
-    if email not in commit_authors:
-        commit_authors[email] = 0
-    commit_authors[email] = commit_authors[email] + 1
+def write_authors(authors_writer):
+    # Docs carry absolute counts (the state file holds every earlier run's),
+    # so writing one again, e.g. after a crash before the state was saved,
+    # never counts anything twice
+    repos = authors.repos_by_row()
+    written = 0
+    # Authors only known from the state file didn't change
+    for row in sorted(authors.touched, key=lambda row: authors.keys[row]):
+        doc = author_doc(row, repos.get(row, {}))
+        authors_writer.add({"index": {"_index": authors_index, "_id": doc["email"]}}, doc)
+        written += 1
+    print("Queued aggregates for " + str(written) + " authors")
 
-    # Index authors' first-commit time (oldest)
-    if email not in authors_first_commit:
-        authors_first_commit[email] = commit_time
+
+def load_identities(identity_map):
+    if identity_map is not None:
+        identities.load_mailmap_file(identity_map)
+    for repo_name in repo_names():
+        identities.load_repo_mailmap(repo_name)
+
+
+# Bumped whenever the shape of indexed docs changes, forcing a full rebuild
+STATE_VERSION = 3
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(path):
+    # Write then rename so a crash never leaves a half-written state file behind
+    with open(path + ".tmp", "w") as f:
+        json.dump({
+            "version": STATE_VERSION,
+            "index": target_index,
+            "authors_index": authors_index,
+            "heads": indexed_heads,
+            "authors": authors.dump()
+        }, f)
+    os.replace(path + ".tmp", path)
+
+
+def swap_alias(alias, new_index):
+    # Point the alias at the freshly built index in one atomic request, then
+    # drop whatever it pointed at before
+    actions = [{"add": {"index": new_index, "alias": alias}}]
+    old_indices = []
+    try:
+        old_indices = [name for name in es.indices.get_alias(name=alias).keys() if name != new_index]
+    except NotFoundError:
+        if es.indices.exists(index=alias):
+            # Pre-alias deployments wrote to a concrete index with the alias' name
+            actions.insert(0, {"remove_index": {"index": alias}})
+
+    for name in old_indices:
+        actions.insert(0, {"remove": {"index": name, "alias": alias}})
+
+    es.indices.update_aliases(actions=actions)
+    print("Alias " + alias + " now points at " + new_index)
+
+    for name in old_indices:
+        es.indices.delete(index=name)
+        print("Deleted old index " + name + "...")
+
+
+def exit_on_errors(bulk_writer):
+    # Saving state would mark the failed commits as indexed for good, and
+    # swapping aliases would serve an incomplete index, so stop before either
+    if bulk_writer.total_errors > 0:
+        print(
+            "%d docs failed to index into %s, not saving state or swapping aliases"
+            % (bulk_writer.total_errors, bulk_writer.index)
+        )
+        sys.exit(1)
+
+
+def main():
+    global target_index, authors_index, writer
+
+    parser = argparse.ArgumentParser(description="Index commit history of every repo in ./repos into Elasticsearch")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes extracting commits in parallel, one repo per task (1 = serial)"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=sorted(EXTRACTORS.keys()),
+        default="gitpython",
+        help="How commits are read: GitPython objects, or one streamed `git log` per repo"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only index commits added since the last run (falls back to a full rebuild without state)"
+    )
+    parser.add_argument(
+        "--state-file",
+        default="repoagg-state.json",
+        help="Where the last indexed HEAD of every repo is kept between runs"
+    )
+    parser.add_argument(
+        "--bulk-docs",
+        type=int,
+        default=500,
+        help="Flush a bulk request once it holds this many documents"
+    )
+    parser.add_argument(
+        "--bulk-bytes",
+        type=int,
+        default=5 * 1024 * 1024,
+        help="Flush a bulk request once it reaches this many bytes"
+    )
+    parser.add_argument(
+        "--bulk-in-flight",
+        type=int,
+        default=4,
+        help="Bulk requests allowed on the wire at once while extraction continues (0 = upload inline)"
+    )
+    parser.add_argument(
+        "--identity-map",
+        default=None,
+        help="Org-wide file in .mailmap format merging author emails across all repos"
+    )
+    parser.add_argument(
+        "--sync-org",
+        default=None,
+        help="Clone/fetch blobless mirrors of every repo in this GitHub org into ./repos first (needs gh)"
+    )
+    parser.add_argument(
+        "--sync-urls",
+        default=None,
+        help="Like --sync-org, but mirror the clone URLs listed one per line in this file"
+    )
+    args = parser.parse_args()
+
+    if args.sync_org is not None or args.sync_urls is not None:
+        urls = org_repo_urls(args.sync_org) if args.sync_org is not None else read_repo_urls(args.sync_urls)
+        print("Syncing " + str(len(urls)) + " mirrors...")
+        sync_mirrors(urls, directory, args.workers)
+
+    state = load_state(args.state_file) if args.incremental else None
+    if state is not None and state.get("version") != STATE_VERSION:
+        print("State file is from an older version of repoagg, doing a full rebuild...")
+        state = None
+
+    if state is not None:
+        target_index = state["index"]
+        authors_index = state["authors_index"]
+        indexed_heads.update(state["heads"])
+        authors.load(state["authors"])
+        print("Incrementally indexing into " + target_index + "...")
     else:
-        time_prev = authors_first_commit[email]
-        if time_prev > commit_time:
-            authors_first_commit[email] = commit_time
+        suffix = "-" + datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+        target_index = INDEX_ALIAS + suffix
+        authors_index = AUTHORS_ALIAS + suffix
+        print("Creating new indices " + target_index + " and " + authors_index + "...")
+        es.indices.create(index=target_index)
+        es.indices.create(index=authors_index, mappings=AUTHORS_MAPPINGS)
+
+    writer = BulkWriter(
+        es,
+        target_index,
+        max_docs=args.bulk_docs,
+        max_bytes=args.bulk_bytes,
+        in_flight=args.bulk_in_flight,
+        retry_on=(ESConnectionError, ConnectionTimeout)
+    )
+
+    # Every mailmap has to be known before the first commit is keyed
+    load_identities(args.identity_map)
+
+    tasks = list(repo_tasks(indexed_heads))
+    for repo_name, head, rev in tasks:
+        if ".." not in rev:
+            # Walked from scratch, so whatever it counted before is counted again
+            authors.reset_repo(repo_name)
+            if state is not None:
+                delete_repo_docs(repo_name)
+
+    # This is where all the real work takes place, in a single pass over every repo
+    on_all_commits(index, tasks, args.workers, args.backend)
 
+    # Complete flush of buffer, and wait for uploads still in flight
+    writer.close()
+    writer.report()
+    exit_on_errors(writer)
 
-def index(repo_name, commit):
-    # Evil but wutevs
-    global bulk_actions
+    print("Author table: %d authors in %.1f MiB" % (len(authors), authors.memory_footprint() / 1024 / 1024))
 
-    # Buffer bulk upload records and upload when appropriate
-    bulk_actions = bulk_actions + bulk_actions_for_commit(repo_name, commit, authors_first_commit)
+    apply_first_contribution_dates(changed_first_commit)
 
-    if len(bulk_actions) > 500:
-        es.bulk(index="search-github-contributors", operations=bulk_actions)
-        print("Successful bulk upload chunk!")
-        bulk_actions = []
+    authors_writer = BulkWriter(
+        es,
+        authors_index,
+        max_docs=args.bulk_docs,
+        max_bytes=args.bulk_bytes,
+        in_flight=args.bulk_in_flight,
+        retry_on=(ESConnectionError, ConnectionTimeout)
+    )
+    write_authors(authors_writer)
+    authors_writer.close()
+    authors_writer.report()
+    exit_on_errors(authors_writer)
 
+    if state is None:
+        swap_alias(INDEX_ALIAS, target_index)
+        swap_alias(AUTHORS_ALIAS, authors_index)
 
-# This is where all the real work takes place
-on_all_commits(preprocess)
-on_all_commits(index)
+    save_state(args.state_file)
 
-# Complete flush of buffer
-if len(bulk_actions) > 0:
-    es.bulk(index="search-github-contributors", operations=bulk_actions)
 
-print("Successful bulk upload!")
+if __name__ == "__main__":
+    main()
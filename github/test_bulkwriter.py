@@ -0,0 +1,135 @@
+# BulkWriter against a stub Elasticsearch: python -m pytest test_bulkwriter.py
+import json
+from bulkwriter import BulkWriter
+
+
+class StubElasticsearch:
+    # Answers bulk() with one response per call from `responses`, after that
+    # accepts everything. A response can be an exception to raise.
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.requests = []
+
+    def bulk(self, index, operations):
+        lines = operations.decode().splitlines()
+        docs = [json.loads(line) for line in lines[1::2]]
+        self.requests.append(docs)
+        if self.responses:
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            if callable(response):
+                return response(docs)
+            return response
+        return {"errors": False, "items": [{"index": {"status": 201}} for _ in docs]}
+
+
+def add_docs(writer, count):
+    for i in range(count):
+        writer.add({"index": {"_id": str(i)}}, {"n": i})
+
+
+def test_malformed_response_counts_the_batch_as_errors():
+    client = StubElasticsearch([{"errors": True}])
+    writer = BulkWriter(client, "test", max_docs=5, in_flight=2)
+    add_docs(writer, 10)
+    writer.close()
+    assert writer.total_errors == 5
+    assert writer.total_docs == 10
+
+
+class TransportError(Exception):
+    pass
+
+
+class TooManyRequests(Exception):
+    status_code = 429
+
+
+def rejecting(first):
+    # Rejects the first `first` docs of the request with 429
+    def response(docs):
+        return {
+            "errors": True,
+            "items": [{"index": {"status": 429 if i < first else 201}} for i in range(len(docs))]
+        }
+    return response
+
+
+def test_flushes_by_doc_count():
+    client = StubElasticsearch()
+    writer = BulkWriter(client, "test", max_docs=4)
+    add_docs(writer, 10)
+    assert [len(docs) for docs in client.requests] == [4, 4]
+    writer.close()
+    assert [len(docs) for docs in client.requests] == [4, 4, 2]
+    assert [doc["n"] for docs in client.requests for doc in docs] == list(range(10))
+    assert writer.total_docs == 10 and writer.total_errors == 0
+
+
+def test_flushes_by_bytes():
+    client = StubElasticsearch()
+    writer = BulkWriter(client, "test", max_docs=1000, max_bytes=200)
+    for i in range(10):
+        writer.add({"index": {"_id": str(i)}}, {"text": "x" * 50})
+    writer.close()
+    assert len(client.requests) > 1
+    # Each action + source pair is about 80 bytes, so a request holds three
+    assert all(len(docs) <= 3 for docs in client.requests)
+    assert writer.total_docs == 10
+
+
+def test_rejected_items_are_retried_alone():
+    client = StubElasticsearch([rejecting(2)])
+    writer = BulkWriter(client, "test", max_docs=5, backoff=0)
+    add_docs(writer, 5)
+    writer.close()
+    assert [[doc["n"] for doc in docs] for docs in client.requests] == [[0, 1, 2, 3, 4], [0, 1]]
+    assert writer.total_retries == 2 and writer.total_errors == 0
+
+
+def test_rejected_items_fail_after_max_retries():
+    client = StubElasticsearch([rejecting(1)] * 3)
+    writer = BulkWriter(client, "test", max_docs=2, max_retries=2, backoff=0)
+    add_docs(writer, 2)
+    writer.close()
+    assert len(client.requests) == 3
+    assert writer.total_retries == 2 and writer.total_errors == 1
+
+
+def test_whole_request_429_and_transport_errors_are_retried():
+    client = StubElasticsearch([TooManyRequests("slow down"), ConnectionError("reset"), TransportError("timeout")])
+    writer = BulkWriter(client, "test", max_docs=3, backoff=0, retry_on=(TransportError,))
+    add_docs(writer, 3)
+    writer.close()
+    assert len(client.requests) == 4
+    assert writer.total_retries == 9 and writer.total_errors == 0
+
+
+def test_other_request_errors_count_every_doc():
+    client = StubElasticsearch([ValueError("bad request")])
+    writer = BulkWriter(client, "test", max_docs=3, backoff=0)
+    add_docs(writer, 3)
+    writer.close()
+    assert len(client.requests) == 1
+    assert writer.total_errors == 3
+
+
+def test_item_errors_are_counted():
+    client = StubElasticsearch([{
+        "errors": True,
+        "items": [{"index": {"status": 400, "error": {"type": "mapper_parsing_exception"}}}, {"index": {"status": 201}}]
+    }])
+    writer = BulkWriter(client, "test", max_docs=2, backoff=0)
+    add_docs(writer, 2)
+    writer.close()
+    assert writer.total_errors == 1 and writer.total_retries == 0
+
+
+def test_in_flight_writes_add_up():
+    client = StubElasticsearch([rejecting(1)])
+    writer = BulkWriter(client, "test", max_docs=7, in_flight=3, backoff=0)
+    add_docs(writer, 100)
+    writer.close()
+    assert writer.total_docs == 100 and writer.total_errors == 0
+    assert sorted(doc["n"] for docs in client.requests for doc in docs) == sorted(list(range(100)) + [0])
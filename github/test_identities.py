@@ -0,0 +1,70 @@
+# python -m pytest test_identities.py
+import subprocess
+from identities import IdentityResolver, UnionFind, normalize_email
+
+
+def test_noreply_addresses_with_and_without_id_are_one_account():
+    assert normalize_email("12345+Octo@users.noreply.github.com") == "octo@users.noreply.github.com"
+    assert normalize_email(" Octo@Users.Noreply.GitHub.com ") == "octo@users.noreply.github.com"
+    assert normalize_email("Jane@Example.com") == "jane@example.com"
+
+    resolver = IdentityResolver()
+    assert resolver.resolve("12345+octo@users.noreply.github.com") == resolver.resolve("octo@users.noreply.github.com")
+
+
+def test_union_find_merges_transitively_and_picks_the_best_member():
+    sets = UnionFind()
+    sets.union("b@users.noreply.github.com", "z@example.com")
+    sets.union("c@example.com", "d@example.com")
+    assert sets.find("z@example.com") != sets.find("c@example.com")
+    sets.union("z@example.com", "d@example.com")
+    root = sets.find("c@example.com")
+    assert all(sets.find(email) == root for email in ("b@users.noreply.github.com", "z@example.com", "d@example.com"))
+    # Real addresses beat noreply ones, then alphabetical order
+    assert sets.canonical("b@users.noreply.github.com") == "c@example.com"
+    sets.prefer("z@example.com")
+    assert sets.canonical("c@example.com") == "z@example.com"
+    assert sets.size[root] == 4
+
+
+def test_mailmap_entries_merge_addresses_globally():
+    resolver = IdentityResolver()
+    resolver.load_mailmap(
+        "# comment\n"
+        "Jane Doe <jane@example.com>\n"
+        "<jane@example.com> <JANE@old.example.com>\n"
+        "Jane Doe <jane@example.com> Jane <1+jane@users.noreply.github.com>\n"
+        "not a mailmap line\n"
+    )
+    key = resolver.resolve("jane@old.example.com")
+    assert key == "jane@example.com"
+    assert resolver.resolve("jane@users.noreply.github.com") == key
+    assert resolver.resolve("other@example.com") == "other@example.com"
+    assert resolver.name(key, "J. Doe") == "Jane Doe"
+    assert resolver.name("other@example.com", "Other") == "Other"
+
+
+def test_later_mailmaps_update_cached_keys():
+    resolver = IdentityResolver()
+    assert resolver.resolve("old@example.com") == "old@example.com"
+    resolver.load_mailmap("<new@example.com> <old@example.com>\n")
+    assert resolver.resolve("old@example.com") == "new@example.com"
+
+
+def test_repo_mailmap_is_read_from_head_of_a_bare_repo(tmp_path):
+    work = tmp_path / "work"
+    subprocess.run(["git", "init", "-q", str(work)], check=True)
+    (work / ".mailmap").write_text("Jane Doe <jane@example.com> <jd@laptop.local>\n")
+    subprocess.run(["git", "-C", str(work), "add", ".mailmap"], check=True)
+    subprocess.run(
+        ["git", "-C", str(work), "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "mailmap"],
+        check=True
+    )
+    bare = tmp_path / "bare.git"
+    subprocess.run(["git", "clone", "-q", "--bare", str(work), str(bare)], check=True)
+
+    resolver = IdentityResolver()
+    resolver.load_repo_mailmap(str(bare))
+    resolver.load_repo_mailmap(str(tmp_path / "missing"))
+    assert resolver.resolve("jd@laptop.local") == "jane@example.com"
+    assert resolver.name("jane@example.com", "jd") == "Jane Doe"
@@ -0,0 +1,71 @@
+# Mirrors of temporary bare repos: python -m pytest test_mirrors.py
+import os, subprocess
+from mirrors import mirror_name, read_repo_urls, sync_mirror, sync_mirrors
+
+
+def git(*args):
+    return subprocess.run(["git"] + list(args), stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+
+
+def commit(work, message):
+    git("-C", work, "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "--allow-empty", "-m", message)
+    return git("-C", work, "rev-parse", "HEAD")
+
+
+def origin(tmp_path, name="origin"):
+    # A bare repo to mirror, and a working clone that pushes to it
+    bare = str(tmp_path / (name + ".git"))
+    work = str(tmp_path / (name + "-work"))
+    git("init", "-q", "--bare", bare)
+    git("clone", "-q", bare, work)
+    commit(work, "first")
+    git("-C", work, "push", "-q", "origin", "HEAD:refs/heads/main")
+    return bare, work
+
+
+def test_mirror_names_and_url_lists(tmp_path):
+    assert mirror_name("git@github.com:org/repo.git") == "repo"
+    assert mirror_name("https://github.com/org/repo/") == "repo"
+    assert mirror_name("/srv/git/repo") == "repo"
+    path = tmp_path / "urls.txt"
+    path.write_text("# mirrored\ngit@github.com:org/a.git\n\n  git@github.com:org/b.git  \n")
+    assert read_repo_urls(str(path)) == ["git@github.com:org/a.git", "git@github.com:org/b.git"]
+
+
+def test_clone_then_fetch_keeps_branches_in_sync(tmp_path):
+    bare, work = origin(tmp_path)
+    git("-C", work, "push", "-q", "origin", "HEAD:refs/heads/topic")
+    git("-C", work, "push", "-q", "origin", "HEAD:refs/pull/1/head")
+    mirror = str(tmp_path / "repos" / "origin")
+
+    assert sync_mirror(bare, mirror) == "Cloned " + mirror
+    assert git("-C", mirror, "rev-parse", "--is-bare-repository") == "true"
+    assert os.path.exists(os.path.join(mirror, "objects", "info", "commit-graphs"))
+
+    head = commit(work, "second")
+    git("-C", work, "push", "-q", "origin", "HEAD:refs/heads/main")
+    git("-C", work, "push", "-q", "origin", "--delete", "topic")
+    assert sync_mirror(bare, mirror) == "Fetched " + mirror
+
+    refs = git("-C", mirror, "for-each-ref", "--format=%(refname)").split()
+    assert refs == ["refs/heads/main"]
+    assert git("-C", mirror, "rev-parse", "refs/heads/main") == head
+    assert git("-C", mirror, "config", "fetch.writeCommitGraph") == "true"
+
+
+def test_working_tree_clones_are_left_alone(tmp_path):
+    bare, work = origin(tmp_path)
+    assert sync_mirror(bare, work).startswith("Skipped " + work)
+
+
+def test_failed_clone_is_reported(tmp_path):
+    message = sync_mirror(str(tmp_path / "missing.git"), str(tmp_path / "repos" / "missing"))
+    assert message.startswith("Failed to sync ")
+
+
+def test_sync_mirrors_creates_the_directory_and_every_mirror(tmp_path, capsys):
+    urls = [origin(tmp_path, name)[0] for name in ("a", "b", "c")]
+    directory = str(tmp_path / "repos")
+    sync_mirrors(urls, directory, jobs=2)
+    assert sorted(os.listdir(directory)) == ["a", "b", "c"]
+    assert capsys.readouterr().out.count("Cloned ") == 3
@@ -0,0 +1,203 @@
+import atexit, fcntl, json, os, random, threading, time
+from sketch import LogSketch
+
+
+class Aggregator:
+    # Folds metrics in memory and lets a background thread send one packed
+    # batch per interval: counters are summed per key, gauges keep their last
+    # value and timers keep up to max_samples samples per key (reservoir
+    # sampled, sent with a sample rate so statsd still counts them right).
+    #
+    # With timer_mode "sketch" timer samples are folded into a LogSketch per
+    # key instead and only the results are sent: <key>.count as a counter and
+    # <key>.mean, <key>.max and <key>.p<N> for each of percentiles as gauges.
+    # That's a handful of lines per key and interval however many samples
+    # came in, and statsd has nothing left to sort. The series move to
+    # stats.gauges.<key>.* / stats.<key>.count though.
+    #
+    # Under gunicorn every worker process has its own aggregator; the thread
+    # is started lazily so it is created after the fork. Statsd keeps only the
+    # last value of a gauge, so percentiles can't be sent per worker: with a
+    # sketch_dir each worker writes its sketches there as
+    # <interval slot>.<worker>.json, and whichever worker gets the lock merges
+    # every slot that is two intervals old and sends one set of lines for it.
+
+    def __init__(self, client, interval=1.0, max_samples=1000, timer_mode="samples", percentiles=(50, 90, 99), accuracy=0.01, sketch_dir=None):
+        self.client = client
+        self.interval = interval
+        self.max_samples = max_samples
+        self.timer_mode = timer_mode
+        self.percentiles = percentiles
+        self.accuracy = accuracy
+        self.sketch_dir = sketch_dir
+        if sketch_dir is not None:
+            os.makedirs(sketch_dir, exist_ok=True)
+        self.sketch_files = 0
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.thread = None
+        self.pid = None
+
+        self.flushes = 0
+        self.flush_lag = 0.0
+        self.flush_duration = 0.0
+        self.metrics_in = 0
+        self.metrics_out = 0
+
+    def ensure_started(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    self.thread = threading.Thread(target=self.run, name="aggregator", daemon=True)
+                    self.thread.start()
+                    atexit.register(self.flush, True)
+
+    def incr(self, key, value):
+        self.ensure_started()
+        with self.lock:
+            self.metrics_in += 1
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, key, value):
+        self.ensure_started()
+        with self.lock:
+            self.metrics_in += 1
+            self.gauges[key] = value
+
+    def timing(self, key, value):
+        self.ensure_started()
+        with self.lock:
+            self.metrics_in += 1
+            if self.timer_mode == "sketch":
+                sketch = self.timers.get(key)
+                if sketch is None:
+                    sketch = self.timers[key] = LogSketch(self.accuracy)
+                sketch.add(value)
+                return
+            samples = self.timers.get(key)
+            if samples is None:
+                samples = self.timers[key] = [0, []]
+            samples[0] += 1
+            if len(samples[1]) < self.max_samples:
+                samples[1].append(value)
+            else:
+                i = random.randrange(samples[0])
+                if i < self.max_samples:
+                    samples[1][i] = value
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+        while True:
+            time.sleep(max(deadline - time.monotonic(), 0))
+            # How late this flush starts compared to when it was due
+            self.flush_lag = time.monotonic() - deadline
+            self.flush()
+            deadline += self.interval
+            if deadline < time.monotonic():
+                # Fell more than an interval behind, don't try to catch up
+                deadline = time.monotonic() + self.interval
+
+    def flush(self, final=False):
+        start = time.monotonic()
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+            timers, self.timers = self.timers, {}
+
+        sent = 0
+        with self.client.pipeline() as pipe:
+            for key, value in counters.items():
+                pipe.incr(key, value)
+                sent += 1
+            for key, value in gauges.items():
+                pipe.gauge(key, value)
+                sent += 1
+            if self.timer_mode == "sketch" and self.sketch_dir is not None:
+                self.share_sketches(timers)
+                # On the way out, send what the other workers left too
+                sent += self.merge_shared_sketches(pipe, final)
+            elif self.timer_mode == "sketch":
+                sent += self.send_sketches(pipe, timers)
+            else:
+                for key, (seen, samples) in timers.items():
+                    rate = len(samples) / seen
+                    for value in samples:
+                        # Already sampled, the forwarder only tags the rate
+                        pipe.timing(key, value, rate)
+                    sent += len(samples)
+
+        self.flushes += 1
+        self.metrics_out += sent
+        self.flush_duration = time.monotonic() - start
+
+    def send_sketches(self, pipe, sketches):
+        sent = 0
+        for key, sketch in sketches.items():
+            pipe.incr(key + ".count", sketch.count)
+            pipe.gauge(key + ".mean", round(sketch.mean(), 3))
+            pipe.gauge(key + ".max", sketch.max)
+            for percentile in self.percentiles:
+                # 99.9 becomes <key>.p99_9
+                name = "%s.p%s" % (key, ("%g" % percentile).replace(".", "_"))
+                pipe.gauge(name, round(sketch.quantile(percentile / 100), 3))
+            sent += 3 + len(self.percentiles)
+        return sent
+
+    def share_sketches(self, sketches):
+        if not sketches:
+            return
+        self.sketch_files += 1
+        slot = int(time.time() // self.interval)
+        path = os.path.join(self.sketch_dir, "%d.%d-%x-%d.json" % (slot, os.getpid(), id(self), self.sketch_files))
+        with open(path + ".tmp", "w") as f:
+            json.dump({key: sketch.state() for key, sketch in sketches.items()}, f)
+        os.replace(path + ".tmp", path)
+
+    def merge_shared_sketches(self, pipe, everything=False):
+        # Slots still being written to are left alone, unless this is the last flush
+        newest = int(time.time() // self.interval) - 2
+        with open(os.path.join(self.sketch_dir, ".lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is merging
+                return 0
+            slots = {}
+            for name in os.listdir(self.sketch_dir):
+                if name.endswith(".json"):
+                    slot = int(name.split(".", 1)[0])
+                    if everything or slot <= newest:
+                        slots.setdefault(slot, []).append(os.path.join(self.sketch_dir, name))
+
+            sent = 0
+            for slot in sorted(slots):
+                merged = {}
+                for path in slots[slot]:
+                    try:
+                        with open(path) as f:
+                            states = json.load(f)
+                    except (FileNotFoundError, ValueError):
+                        continue
+                    os.remove(path)
+                    for key, state in states.items():
+                        sketch = LogSketch.from_state(state, self.accuracy)
+                        if key in merged:
+                            merged[key].merge(sketch)
+                        else:
+                            merged[key] = sketch
+                sent += self.send_sketches(pipe, merged)
+            return sent
+
+    def stats(self):
+        return {
+            "flushes": self.flushes,
+            "flush_interval_seconds": self.interval,
+            "flush_lag_seconds": self.flush_lag,
+            "flush_duration_seconds": self.flush_duration,
+            "metrics_in": self.metrics_in,
+            "metrics_out": self.metrics_out,
+            "pending_keys": len(self.counters) + len(self.gauges) + len(self.timers)
+        }
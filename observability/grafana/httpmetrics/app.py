@@ -1,27 +1,172 @@
-import sys
-import threading, statsd, os
-from flask import Flask, Response, request
+import os, json, math, re, time
+from flask import Flask, Response, g, request
 from dotenv import load_dotenv
 from functools import wraps
+from aggregator import Aggregator
+from auth import BasicAuth, load_credentials
+from forwarder import Forwarder, backend_from_url
+from limits import KeyGuard, RateLimiter
+from selfmetrics import SelfMetrics
 
 load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.urandom(50)
 
-graphite = os.environ.get("GRAPHITE")
-if graphite is None:
-    raise ValueError("Graphite host not configured!")
-metrics = statsd.StatsClient(graphite, 8125, prefix='')
+# Comma separated backends to send metrics to, e.g.
+# udp://graphite:8125,http://pushgateway:9091 (see forwarder.py).
+# Defaults to statsd over UDP on GRAPHITE:STATSD_PORT.
+forward_to = os.environ.get("FORWARD_TO")
+if forward_to is None:
+    graphite = os.environ.get("GRAPHITE")
+    if graphite is None:
+        raise ValueError("Graphite host not configured!")
+    forward_to = "udp://%s:%s" % (graphite, os.environ.get("STATSD_PORT", "8125"))
 
-def check_auth(username, password):
-    return username == 'hackclub' and password == os.environ["BASIC_HTTP_AUTH_SECRET"]
+# With SPOOL_DIR set, metrics for a statsd backend that is down go to disk
+# and are replayed at SPOOL_REPLAY_RATE lines/second once it is back
+spool_dir = os.environ.get("SPOOL_DIR")
+spool_options = {
+    "segment_bytes": int(os.environ.get("SPOOL_SEGMENT_BYTES", 4 << 20)),
+    "max_bytes": int(os.environ.get("SPOOL_MAX_BYTES", 256 << 20))
+}
+metrics = Forwarder([
+    backend_from_url(
+        url.strip(),
+        queue_size=int(os.environ.get("FORWARD_QUEUE_SIZE", "10000")),
+        spool_dir=spool_dir,
+        spool_options=spool_options,
+        replay_rate=float(os.environ.get("SPOOL_REPLAY_RATE", "1000")),
+        health_interval=float(os.environ.get("HEALTH_INTERVAL", "5")),
+        admin_port=int(os.environ.get("STATSD_ADMIN_PORT", "8126"))
+    )
+    for url in forward_to.split(",") if url.strip()
+])
+
+# Optional in-process pre-aggregation, flushed every AGGREGATE_INTERVAL seconds.
+# AGGREGATE_TIMERS=sketch sends timer percentiles instead of samples, merged
+# over all workers through SKETCH_DIR (see gunicorn.conf.py).
+aggregator = None
+if os.environ.get("AGGREGATE", "0") == "1":
+    aggregator = Aggregator(
+        metrics,
+        interval=float(os.environ.get("AGGREGATE_INTERVAL", "1")),
+        max_samples=int(os.environ.get("AGGREGATE_MAX_TIMER_SAMPLES", "1000")),
+        timer_mode=os.environ.get("AGGREGATE_TIMERS", "samples"),
+        percentiles=[float(p) for p in os.environ.get("TIMER_PERCENTILES", "50,90,99").split(",")],
+        accuracy=float(os.environ.get("SKETCH_ACCURACY", "0.01")),
+        sketch_dir=os.environ.get("SKETCH_DIR")
+    )
+
+auth = BasicAuth(load_credentials(), cache_size=int(os.environ.get("AUTH_CACHE_SIZE", "1024")))
+
+def load_allowlist():
+    # Glob patterns, comma separated in KEY_ALLOWLIST and/or one per line in KEY_ALLOWLIST_FILE
+    patterns = [pattern.strip() for pattern in os.environ.get("KEY_ALLOWLIST", "").split(",") if pattern.strip()]
+    path = os.environ.get("KEY_ALLOWLIST_FILE")
+    if path is not None:
+        with open(path) as f:
+            patterns += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    return patterns
+
+# Every new key is a new Whisper file on the graphite container, so keys per
+# prefix are capped. Under gunicorn the workers share the admitted keys
+# through KEY_GUARD_FILE (see gunicorn.conf.py).
+key_guard = KeyGuard(
+    load_allowlist(),
+    prefix_depth=int(os.environ.get("KEY_PREFIX_DEPTH", "2")),
+    max_keys=int(os.environ.get("MAX_KEYS_PER_PREFIX", "2000")),
+    max_prefixes=int(os.environ.get("MAX_KEY_PREFIXES", "200")),
+    path=os.environ.get("KEY_GUARD_FILE")
+)
+
+# Optional per-client limit of RATE_LIMIT metrics/second over all workers
+rate_limiter = None
+if float(os.environ.get("RATE_LIMIT", "0")) > 0:
+    rate = float(os.environ["RATE_LIMIT"])
+    rate_limiter = RateLimiter(
+        rate,
+        burst=float(os.environ.get("RATE_LIMIT_BURST", rate * 10)),
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1"))
+    )
+
+# Our own health, scraped by Prometheus from /metrics
+selfmetrics = SelfMetrics(
+    max_series=int(os.environ.get("SELFMETRICS_MAX_SERIES", "1000")),
+    directory=os.environ.get("METRICS_DIR")
+)
+selfmetrics.describe("httpmetrics_requests_total", "counter", "HTTP requests by route and status")
+selfmetrics.describe("httpmetrics_request_duration_seconds", "histogram", "HTTP request latency by route")
+selfmetrics.describe("httpmetrics_rejected_total", "counter", "Requests rejected, by reason")
+selfmetrics.describe("httpmetrics_metrics_received_total", "counter", "Metrics accepted, by statsd type")
+selfmetrics.describe("httpmetrics_forward_sent_total", "counter", "Metrics sent, by backend")
+selfmetrics.describe("httpmetrics_forward_dropped_total", "counter", "Metrics dropped because a backend was full or failing, by backend")
+selfmetrics.describe("httpmetrics_forward_errors_total", "counter", "Failed sends, by backend")
+selfmetrics.describe("httpmetrics_forward_queued", "gauge", "Batches waiting in a backend's queue")
+selfmetrics.describe("httpmetrics_forward_down", "gauge", "1 while a backend is failing its health check")
+selfmetrics.describe("httpmetrics_spool_bytes", "gauge", "Bytes waiting in a backend's spool")
+selfmetrics.describe("httpmetrics_spool_replayed_total", "counter", "Metrics replayed from the spool, by backend")
+selfmetrics.describe("httpmetrics_spool_dropped_total", "counter", "Spooled metrics deleted to stay under SPOOL_MAX_BYTES, by backend")
+selfmetrics.describe("httpmetrics_auth_requests_total", "counter", "Authenticated requests by service")
+selfmetrics.describe("httpmetrics_aggregator_flush_lag_seconds", "gauge", "How late the last aggregator flush started")
+selfmetrics.describe("httpmetrics_keys_rejected_total", "counter", "Metrics dropped by the key cardinality limit, by key prefix")
+selfmetrics.describe("httpmetrics_key_prefixes", "gauge", "Key prefixes tracked by the cardinality limit")
+selfmetrics.describe("httpmetrics_rate_limited_total", "counter", "Requests refused by the rate limit, by service")
+
+def collect(registry):
+    for backend, backend_stats in metrics.stats().items():
+        labels = (("backend", backend),)
+        registry.set("httpmetrics_forward_sent_total", backend_stats["sent"], labels)
+        registry.set("httpmetrics_forward_dropped_total", backend_stats["dropped"], labels)
+        registry.set("httpmetrics_forward_errors_total", backend_stats["errors"], labels)
+        registry.set("httpmetrics_forward_queued", backend_stats["queued"], labels)
+        if "spool" in backend_stats:
+            registry.set("httpmetrics_forward_down", int(backend_stats["down"]), labels)
+            registry.set("httpmetrics_spool_bytes", backend_stats["spool"]["bytes"], labels)
+            registry.set("httpmetrics_spool_replayed_total", backend_stats["replayed"], labels)
+            registry.set("httpmetrics_spool_dropped_total", backend_stats["spool"]["dropped"], labels)
+    for service, count in auth.stats()["requests"].items():
+        registry.set("httpmetrics_auth_requests_total", count, (("service", service),))
+    if aggregator is not None:
+        registry.set("httpmetrics_aggregator_flush_lag_seconds", aggregator.flush_lag)
+    keys = key_guard.stats()
+    registry.set("httpmetrics_key_prefixes", keys["prefixes"])
+    for prefix, count in keys["rejected"].items():
+        registry.set("httpmetrics_keys_rejected_total", count, (("prefix", prefix),))
+    if rate_limiter is not None:
+        for service, count in rate_limiter.stats()["limited"].items():
+            registry.set("httpmetrics_rate_limited_total", count, (("service", service),))
+
+selfmetrics.add_collector(collect)
+
+def reject(reason, body, status):
+    selfmetrics.inc("httpmetrics_rejected_total", (("reason", reason),))
+    return Response(body, status=status)
+
+def count_received(typ, count=1):
+    selfmetrics.inc("httpmetrics_metrics_received_total", (("type", typ if typ in ("c", "t", "g") else "other"),), count)
+
+@app.before_request
+def start_timer():
+    request.environ["httpmetrics.start"] = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    # Route templates rather than paths, so label values stay bounded
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    selfmetrics.inc("httpmetrics_requests_total", (("route", route), ("status", str(response.status_code))))
+    start = request.environ.get("httpmetrics.start")
+    if start is not None:
+        selfmetrics.observe("httpmetrics_request_duration_seconds", time.perf_counter() - start, (("route", route),))
+    return response
 
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
-            return "nope", 401
+        service = auth.verify(request.headers.get("Authorization", ""))
+        if service is None:
+            return reject("auth", "nope", 401)
+        auth.count(service)
+        g.service = service
         return f(*args, **kwargs)
     return decorated_function
 
@@ -29,6 +174,39 @@ def login_required(f):
 def index():
     return Response("Yo", status=200)
 
+# Keys go into statsd lines ("key:value|type@rate") and graphite paths, so
+# only plain ASCII name characters are allowed
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_.\-]{1,255}\Z")
+
+def valid_key(key):
+    return isinstance(key, str) and KEY_PATTERN.match(key) is not None
+
+def parse_value(typ, value):
+    # The same rules for /mtx params, JSON batches and statsd lines. Timers are
+    # whole milliseconds; nan and inf would be forwarded as-is and break statsd.
+    if isinstance(value, bool):
+        raise ValueError("boolean value")
+    if typ == "t":
+        if isinstance(value, float) and not value.is_integer():
+            raise ValueError("timer must be whole milliseconds")
+        return int(value)
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("value must be finite")
+    return value
+
+def send_metric(client, key, typ, value):
+    # client is the forwarder, one of its pipelines or the aggregator
+    if typ == "c":
+        # Counters, floating-point OK
+        client.incr(key, float(value))
+    elif typ == "t":
+        # Time, milliseconds
+        client.timing(key, int(value))
+    elif typ == "g":
+        # Custom sampling - floating point
+        client.gauge(key, float(value))
+
 @app.route("/mtx", methods=["POST"])
 @login_required
 def mtx():
@@ -38,26 +216,125 @@ def mtx():
     value = args.get("v", None)
 
     if key == None or typ == None or value == None:
-        return Response("Must supply key, type, and value", status=400)
+        return reject("missing_params", "Must supply key, type, and value", 400)
 
-    if typ == "c":
-        # Counters, floating-point OK
-        metrics.incr(key, float(value))
-    elif typ == "t":
-        # Time, milliseconds
-        metrics.timer(key, int(value))
-    elif typ == "g":
-        # Custom sampling - floating point
-        metrics.gauge(key, float(value))
+    if not valid_key(key):
+        return reject("bad_key", "Key may only contain letters, digits, '_', '-' and '.'", 400)
+
+    if rate_limiter is not None and not rate_limiter.allow(g.service):
+        return reject("rate_limited", "Too many metrics, slow down", 429)
+
+    try:
+        value = parse_value(typ, value)
+    except ValueError:
+        return reject("parse_error", "Value must be a finite number, whole milliseconds for timers", 400)
+
+    if not key_guard.allowed(key):
+        return reject("key_rejected", "Too many distinct keys under this prefix", 422)
+
+    send_metric(aggregator or metrics, key, typ, value)
+    count_received(typ)
 
     #print("key: " + key)
     #print("value: " + value)
 
     return Response(status=200)
 
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "5000"))
+
+def parse_metric(key, typ, value):
+    if not valid_key(key) or typ not in ("c", "t", "g"):
+        raise ValueError("bad key or type")
+    # Validate up front so a batch is either sent whole or not at all
+    return key, typ, parse_value(typ, value)
+
+def parse_batch(body, content_type):
+    # Either a JSON array of {"k", "t", "v"} objects like the /mtx query params,
+    # or newline-delimited statsd-style "key:value|type" lines
+    parsed = []
+    errors = []
+    if content_type.startswith("application/json"):
+        try:
+            items = json.loads(body)
+        except ValueError:
+            return [], ["body is not valid JSON"]
+        if not isinstance(items, list):
+            return [], ["body must be a JSON array"]
+        for i, item in enumerate(items):
+            try:
+                parsed.append(parse_metric(item["k"], item["t"], item["v"]))
+            except (KeyError, TypeError, ValueError):
+                errors.append("item %d: must have k (letters, digits, _ - .), t (c|t|g) and a finite numeric v, whole for t" % i)
+    else:
+        for i, line in enumerate(body.splitlines()):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                key, rest = line.rsplit(":", 1)
+                value, typ = rest.split("|", 1)
+                parsed.append(parse_metric(key, typ, value))
+            except ValueError:
+                errors.append("line %d: expected key:value|type with a key of letters, digits, _ - ., a finite value (whole for t) and type c, t or g" % (i + 1))
+    return parsed, errors
+
+@app.route("/mtx/batch", methods=["POST"])
+@login_required
+def mtx_batch():
+    parsed, errors = parse_batch(request.get_data(as_text=True), request.content_type or "")
+
+    if errors:
+        return reject("parse_error", "\n".join(errors[:20]), 400)
+    if len(parsed) > MAX_BATCH:
+        return reject("batch_too_large", "At most %d metrics per batch" % MAX_BATCH, 413)
+    if rate_limiter is not None and not rate_limiter.allow(g.service, len(parsed)):
+        return reject("rate_limited", "Too many metrics, slow down", 429)
+
+    # Keys over the cardinality limit are dropped, the rest of the batch still goes out
+    accepted = [metric for metric in parsed if key_guard.allowed(metric[0])]
+    rejected = len(parsed) - len(accepted)
+    parsed = accepted
+    body = "%d keys rejected by the cardinality limit" % rejected if rejected else None
+
+    for typ in ("c", "t", "g"):
+        count = sum(1 for _, parsed_typ, _ in parsed if parsed_typ == typ)
+        if count:
+            count_received(typ, count)
+
+    if aggregator is not None:
+        for key, typ, value in parsed:
+            send_metric(aggregator, key, typ, value)
+        return Response(body, status=200)
+
+    # The whole batch goes on the backend queues as one item
+    with metrics.pipeline() as pipe:
+        for key, typ, value in parsed:
+            send_metric(pipe, key, typ, value)
+
+    return Response(body, status=200)
+
+@app.route("/stats", methods=["GET"])
+@login_required
+def stats():
+    body = aggregator.stats() if aggregator is not None else {}
+    body["backends"] = metrics.stats()
+    body["auth"] = auth.stats()
+    body["keys"] = key_guard.stats()
+    if rate_limiter is not None:
+        body["rate_limit"] = rate_limiter.stats()
+    return Response(json.dumps(body), status=200, mimetype="application/json")
+
+@app.route("/metrics", methods=["GET"])
+@login_required
+def prometheus_metrics():
+    return Response(selfmetrics.render(), status=200, mimetype="text/plain; version=0.0.4")
+
 
 def start_server():
-    app.run(host='0.0.0.0', port=8100, debug=True, use_reloader=False)
+    # Development only, production runs under gunicorn (see gunicorn.conf.py)
+    debug = os.environ.get("DEBUG", "0") == "1"
+    app.run(host='0.0.0.0', port=8100, debug=debug, use_reloader=False)
 
-threading.Thread(target=start_server).start()
+if __name__ == "__main__":
+    start_server()
 
@@ -0,0 +1,62 @@
+import base64, binascii, hmac, os, threading
+from collections import Counter
+from functools import lru_cache
+
+
+def load_credentials():
+    # AUTH_TOKENS_FILE holds one "service:secret" per line so every client can
+    # get (and rotate) its own secret. Without it the old single
+    # hackclub:BASIC_HTTP_AUTH_SECRET login keeps working, plus
+    # prometheus:METRICS_SCRAPE_SECRET for scraping /metrics when that is set.
+    path = os.environ.get("AUTH_TOKENS_FILE")
+    if path is None:
+        credentials = {"hackclub": os.environ["BASIC_HTTP_AUTH_SECRET"]}
+        if os.environ.get("METRICS_SCRAPE_SECRET"):
+            credentials["prometheus"] = os.environ["METRICS_SCRAPE_SECRET"]
+        return credentials
+
+    credentials = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            service, secret = line.split(":", 1)
+            credentials[service] = secret
+    return credentials
+
+
+class BasicAuth:
+    # Verifies Authorization headers against the credentials loaded at
+    # startup. Results are cached per raw header value, so the usual client
+    # sending the same header over and over skips decoding and comparing.
+
+    def __init__(self, credentials, cache_size=1024):
+        self.credentials = {service: secret.encode() for service, secret in credentials.items()}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.verify = lru_cache(maxsize=cache_size)(self.check_header)
+
+    def check_header(self, header):
+        # Returns the service the header authenticates, or None
+        if not header or not header.startswith("Basic "):
+            return None
+        try:
+            username, _, password = base64.b64decode(header[6:], validate=True).decode().partition(":")
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+
+        secret = self.credentials.get(username)
+        # Compare against something even for unknown users, in constant time
+        matches = hmac.compare_digest(password.encode(), secret if secret is not None else b"\0")
+        return username if secret is not None and matches else None
+
+    def count(self, service):
+        with self.lock:
+            self.requests[service] += 1
+
+    def stats(self):
+        info = self.verify.cache_info()
+        with self.lock:
+            requests = dict(self.requests)
+        return {"requests": requests, "cache_hits": info.hits, "cache_misses": info.misses}
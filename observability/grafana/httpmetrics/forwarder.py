@@ -0,0 +1,400 @@
+import atexit, os, queue, re, socket, sys, threading, time, traceback, urllib.request
+from urllib.parse import urlsplit
+from spool import Spool
+
+
+class LineWriter:
+    # The part of the statsd client interface the app uses, writing plain
+    # statsd lines ("key:value|type") to whatever write() does with them
+
+    def incr(self, key, value=1):
+        self.write(["%s:%s|c" % (key, value)])
+
+    def gauge(self, key, value):
+        if value < 0:
+            # A leading sign means "change by" to statsd, so set to 0 first
+            self.write(["%s:0|g" % key, "%s:%s|g" % (key, value)])
+        else:
+            self.write(["%s:%s|g" % (key, value)])
+
+    def timing(self, key, value, rate=1):
+        # Unlike the statsd client this doesn't sample, the rate only tags
+        # samples the caller already picked
+        if rate < 1:
+            self.write(["%s:%0.6f|ms|@%s" % (key, value, rate)])
+        else:
+            self.write(["%s:%0.6f|ms" % (key, value)])
+
+
+class Forwarder(LineWriter):
+    # Fans metrics out to every backend. Handing lines to a backend only puts
+    # them on its queue, so the request path never waits on the network.
+
+    def __init__(self, backends):
+        self.backends = backends
+
+    def write(self, lines):
+        for backend in self.backends:
+            backend.put(lines)
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def stats(self):
+        return {backend.name: backend.stats() for backend in self.backends}
+
+
+class Pipeline(LineWriter):
+    # Collects lines and hands them over as one queue item on exit
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.lines = []
+
+    def write(self, lines):
+        self.lines.extend(lines)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.lines:
+            self.forwarder.write(self.lines)
+            self.lines = []
+
+
+class Backend:
+    # One destination. Lines wait in a bounded queue and a thread per backend
+    # sends them in batches; when the queue is full (the backend is slow or
+    # down) new lines are dropped and counted rather than blocking the caller.
+    #
+    # With a spool, batches that fail to send are written to disk instead and
+    # the backend is marked down. While it is down, or anything is still
+    # spooled, new batches are spooled too so the order is kept. Every
+    # health_interval the backend is checked; once it is healthy the spool is
+    # replayed at no more than replay_rate lines a second.
+    #
+    # The thread is started lazily so under gunicorn it belongs to the worker.
+
+    poll_interval = 1.0
+    replay_poll_interval = 0.1
+
+    def __init__(self, name, queue_size=10000, max_batch=1000, spool=None, health_interval=5.0, replay_rate=1000):
+        self.name = name
+        self.queue = queue.Queue(queue_size)
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pid = None
+
+        self.spool = spool
+        self.health_interval = health_interval
+        self.replay_rate = replay_rate
+        self.down = False
+        self.checked_at = time.monotonic()
+        self.replayed_at = time.monotonic()
+
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.spooled = 0
+        self.replayed = 0
+        # Registered now so it runs after the aggregator's exit flush
+        atexit.register(self.drain)
+
+    def put(self, lines):
+        self.ensure_started()
+        if not all(line.isascii() for line in lines):
+            # statsd lines (and the spool) are ASCII, the app only lets such keys through
+            ascii_lines = [line for line in lines if line.isascii()]
+            self.dropped += len(lines) - len(ascii_lines)
+            lines = ascii_lines
+        try:
+            self.queue.put_nowait(lines)
+        except queue.Full:
+            self.dropped += len(lines)
+
+    def ensure_started(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.pid = os.getpid()
+                    threading.Thread(target=self.run, name="forward %s" % self.name, daemon=True).start()
+
+    def run(self):
+        while True:
+            replaying = self.spool is not None and not self.down and self.spool.pending()
+            try:
+                batch = list(self.queue.get(timeout=self.replay_poll_interval if replaying else self.poll_interval))
+            except queue.Empty:
+                self.guarded(self.tick)
+                continue
+            while len(batch) < self.max_batch:
+                try:
+                    batch.extend(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not self.guarded(self.deliver, batch):
+                self.dropped += len(batch)
+            self.guarded(self.tick)
+
+    def guarded(self, function, *args):
+        # Network errors are handled where they happen; anything else is a bug.
+        # It is counted and printed, but must not end the thread, or every
+        # metric queued after it would be lost without a trace.
+        try:
+            function(*args)
+            return True
+        except Exception:
+            self.errors += 1
+            traceback.print_exc(file=sys.stderr)
+            return False
+
+    def deliver(self, batch):
+        with self.send_lock:
+            if self.spool is not None and (self.down or self.spool.pending()):
+                self.spool.append(batch)
+                self.spooled += len(batch)
+                return
+            try:
+                self.send(batch)
+                self.sent += len(batch)
+            except OSError:
+                self.errors += 1
+                if self.spool is None:
+                    self.dropped += len(batch)
+                    return
+                self.down = True
+                self.spool.append(batch)
+                self.spooled += len(batch)
+
+    def check(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.health_interval:
+            return
+        self.checked_at = now
+        with self.send_lock:
+            self.down = not self.healthy()
+
+    def replay(self):
+        # Called from the sender thread only, between batches
+        if self.spool is None:
+            return
+        self.check()
+        now = time.monotonic()
+        budget = min(int((now - self.replayed_at) * self.replay_rate), self.max_batch)
+        if self.down or budget < 1:
+            return
+        self.replayed_at = now
+        with self.send_lock:
+            lines, position = self.spool.peek(budget)
+            if not lines:
+                return
+            try:
+                self.send(lines)
+            except OSError:
+                self.errors += 1
+                self.down = True
+                return
+            self.spool.advance(position)
+            self.replayed += len(lines)
+            self.sent += len(lines)
+
+    def healthy(self):
+        # Without a better check, try again and let the next send tell
+        return True
+
+    def drain(self):
+        # Send whatever is still queued, on the way out
+        batch = []
+        while True:
+            try:
+                batch.extend(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.deliver(batch)
+        self.tick(force=True)
+        if self.spool is not None and self.spool.writer is not None:
+            self.spool.writer.close()
+
+    def send(self, lines):
+        raise NotImplementedError
+
+    def tick(self, force=False):
+        # Called after every batch and whenever the queue has been idle for poll_interval
+        self.replay()
+
+    def stats(self):
+        stats = {"queued": self.queue.qsize(), "sent": self.sent, "dropped": self.dropped, "errors": self.errors}
+        if self.spool is not None:
+            stats.update(down=self.down, spooled=self.spooled, replayed=self.replayed, spool=self.spool.stats())
+        return stats
+
+
+class StatsdUDP(Backend):
+    # Packs lines into datagrams of at most max_size bytes, 512 like the
+    # statsd client so they are never fragmented.
+    #
+    # Lost UDP packets raise no errors, so health is asked from statsd's TCP
+    # admin interface on admin_port (8126 in graphite-statsd).
+
+    def __init__(self, host, port, max_size=512, admin_port=8126, **kwargs):
+        super().__init__("udp://%s:%d" % (host, port), **kwargs)
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.admin_port = admin_port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addr = None
+
+    def healthy(self):
+        try:
+            with socket.create_connection((self.host, self.admin_port), timeout=2.0) as admin:
+                admin.sendall(b"health\n")
+                return admin.recv(64).startswith(b"health: up")
+        except OSError:
+            return False
+
+    def send(self, lines):
+        if self.addr is None:
+            # Resolved on first use and again after errors, graphite may come back on a new address
+            self.addr = socket.getaddrinfo(self.host, self.port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        try:
+            packet = ""
+            for line in lines:
+                if packet and len(packet) + len(line) + 1 > self.max_size:
+                    self.sock.sendto(packet.encode("ascii"), self.addr)
+                    packet = ""
+                packet = packet + "\n" + line if packet else line
+            if packet:
+                self.sock.sendto(packet.encode("ascii"), self.addr)
+        except OSError:
+            self.addr = None
+            raise
+
+
+class StatsdTCP(Backend):
+    # Newline separated lines over one kept-open connection. After a failure
+    # reconnects are spaced by retry_interval so a dead backend costs little.
+
+    def __init__(self, host, port, timeout=5.0, retry_interval=1.0, **kwargs):
+        super().__init__("tcp://%s:%d" % (host, port), **kwargs)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.sock = None
+        self.retry_at = 0.0
+
+    def send(self, lines):
+        if self.sock is None:
+            if time.monotonic() < self.retry_at:
+                raise OSError("waiting to reconnect to %s" % self.name)
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError:
+                self.retry_at = time.monotonic() + self.retry_interval
+                raise
+        try:
+            self.sock.sendall(("\n".join(lines) + "\n").encode("ascii"))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            self.retry_at = time.monotonic() + self.retry_interval
+            raise
+
+    def healthy(self):
+        if self.sock is not None:
+            return True
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            return True
+        except OSError:
+            return False
+
+
+class Pushgateway(Backend):
+    # Keeps Prometheus style totals of everything it is sent (counter sums,
+    # last gauge values, timer count and sum) and PUTs them to a pushgateway
+    # every push_interval seconds. Each process pushes to its own instance
+    # group, sum over instance in Prometheus to get the totals.
+
+    def __init__(self, url, push_interval=10.0, timeout=5.0, **kwargs):
+        super().__init__(url, **kwargs)
+        self.url = "%s/metrics/job/httpmetrics/instance/%s-%d" % (url.rstrip("/"), socket.gethostname(), os.getpid())
+        self.push_interval = push_interval
+        self.timeout = timeout
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.dirty = False
+        self.pushed_at = time.monotonic()
+
+    def send(self, lines):
+        for line in lines:
+            try:
+                key, rest = line.rsplit(":", 1)
+                fields = rest.split("|")
+                value = float(fields[0])
+            except ValueError:
+                continue
+            name = prometheus_name(key)
+            if fields[1] == "c":
+                self.counters[name] = self.counters.get(name, 0.0) + value
+            elif fields[1] == "g":
+                self.gauges[name] = value
+            elif fields[1] == "ms":
+                # A sampled timer line stands for 1/rate samples
+                rate = float(fields[2][1:]) if len(fields) > 2 else 1.0
+                timer = self.timers.setdefault(name, [0.0, 0.0])
+                timer[0] += 1 / rate
+                timer[1] += value / rate
+        self.dirty = True
+
+    def tick(self, force=False):
+        # Totals survive failed pushes on their own, nothing to spool
+        if not self.dirty or (not force and time.monotonic() - self.pushed_at < self.push_interval):
+            return
+        self.pushed_at = time.monotonic()
+        with self.send_lock:
+            body = self.render()
+            self.dirty = False
+        request = urllib.request.Request(self.url, data=body.encode(), method="PUT")
+        request.add_header("Content-Type", "text/plain; version=0.0.4")
+        try:
+            urllib.request.urlopen(request, timeout=self.timeout).close()
+        except OSError:
+            self.errors += 1
+            self.dirty = True
+
+    def render(self):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines += ["# TYPE %s counter" % name, "%s %r" % (name, value)]
+        for name, value in sorted(self.gauges.items()):
+            lines += ["# TYPE %s gauge" % name, "%s %r" % (name, value)]
+        for name, (count, total) in sorted(self.timers.items()):
+            name += "_milliseconds"
+            lines += ["# TYPE %s summary" % name, "%s_count %r" % (name, count), "%s_sum %r" % (name, total)]
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_name(key):
+    name = re.sub(r"[^a-zA-Z0-9_:]", "_", key)
+    return "_" + name if name[:1].isdigit() else name
+
+
+def backend_from_url(url, spool_dir=None, spool_options=None, admin_port=8126, **kwargs):
+    # udp://host:port and tcp://host:port are statsd, http(s):// is a pushgateway.
+    # Given a spool_dir, statsd backends spool to a directory of their own in it.
+    parts = urlsplit(url)
+    if parts.scheme in ("udp", "tcp") and spool_dir is not None:
+        name = "%s-%s-%d" % (parts.scheme, parts.hostname, parts.port or 8125)
+        kwargs["spool"] = Spool(os.path.join(spool_dir, name), **(spool_options or {}))
+    if parts.scheme == "udp":
+        return StatsdUDP(parts.hostname, parts.port or 8125, admin_port=admin_port, **kwargs)
+    if parts.scheme == "tcp":
+        return StatsdTCP(parts.hostname, parts.port or 8125, **kwargs)
+    if parts.scheme in ("http", "https"):
+        return Pushgateway(url, **kwargs)
+    raise ValueError("Unknown backend %r, expected udp://, tcp:// or http(s)://" % url)
@@ -0,0 +1,37 @@
+# Production server for httpmetrics: gunicorn app:app -c gunicorn.conf.py
+import multiprocessing, os, shutil
+
+bind = "0.0.0.0:8100"
+
+# Each request is a cheap parse plus a UDP send, so a few processes with a
+# handful of threads each keep up without the per-worker memory of many processes
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", "4"))
+
+# nginx keeps connections to us open, don't make it reconnect all the time
+keepalive = 75
+timeout = 30
+graceful_timeout = 10
+
+accesslog = None
+errorlog = "-"
+loglevel = "warning"
+
+# Workers share their self-metrics through snapshot files here (see selfmetrics.py)
+os.environ.setdefault("METRICS_DIR", "/tmp/httpmetrics-metrics")
+# ...and the keys admitted by the cardinality limit through this file (see limits.py)
+os.environ.setdefault("KEY_GUARD_FILE", "/tmp/httpmetrics-keys")
+# ...and their timer sketches through this directory (see aggregator.py)
+os.environ.setdefault("SKETCH_DIR", "/tmp/httpmetrics-sketches")
+# The rate limit is split between the workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+def on_starting(server):
+    # Counts left behind by a previous run of the server don't belong to this one
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
+    shutil.rmtree(os.environ["SKETCH_DIR"], ignore_errors=True)
+    try:
+        os.remove(os.environ["KEY_GUARD_FILE"])
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,220 @@
+import fcntl, fnmatch, hashlib, math, mmap, os, re, struct, threading, time
+from contextlib import contextmanager
+
+UINT64 = struct.Struct("<Q")
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def table_size(entries):
+    # Power of two with room for twice `entries`, so probes stay short
+    return 1 << max(3, (2 * entries - 1).bit_length())
+
+
+class HyperLogLog:
+    # ~3% error distinct counter in 2**precision bytes, for reporting how
+    # many different keys a full prefix turned away
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, hashed):
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are empty
+            return m * math.log(m / zeros)
+        return raw
+
+
+class KeyGuard:
+    # Stops runaway key cardinality before it reaches graphite, where every
+    # new key is a new Whisper file. Keys matching an allowlist pattern always
+    # pass. Other keys are grouped by their first prefix_depth dot segments;
+    # each prefix admits at most max_keys distinct keys and at most
+    # max_prefixes prefixes are tracked. Anything past that is rejected and
+    # counted.
+    #
+    # Admitted keys live as 64-bit hashes in a fixed-size open-addressing
+    # table (8 bytes a slot, at most half full), next to a table of
+    # (prefix hash, key count) pairs. With `path` both are mmapped from that
+    # file, so every gunicorn worker shares one set of caps; writes take an
+    # flock on it. Looking up a key that is already admitted takes no lock.
+
+    MAGIC = b"HMKEYS01"
+    HEADER = struct.Struct("<8sQQQ")
+
+    def __init__(self, allowlist=(), prefix_depth=2, max_keys=2000, max_prefixes=200, path=None):
+        self.allow = re.compile("|".join(fnmatch.translate(pattern) for pattern in allowlist)) if allowlist else None
+        self.prefix_depth = prefix_depth
+        self.max_keys = max_keys
+        self.max_prefixes = max_prefixes
+        self.key_slots = table_size(max_keys * max_prefixes)
+        self.prefix_slots = table_size(max_prefixes)
+        self.keys_offset = self.HEADER.size
+        self.prefixes_offset = self.keys_offset + self.key_slots * 8
+        size = self.prefixes_offset + self.prefix_slots * 16
+
+        self.lock = threading.Lock()
+        self.fd = None
+        if path is None:
+            self.table = mmap.mmap(-1, size)
+            self.HEADER.pack_into(self.table, 0, self.MAGIC, self.key_slots, self.prefix_slots, 0)
+        else:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            with self.locked():
+                header = os.pread(self.fd, self.HEADER.size, 0) if os.fstat(self.fd).st_size == size else b""
+                if header[:24] != self.HEADER.pack(self.MAGIC, self.key_slots, self.prefix_slots, 0)[:24]:
+                    # New, or left behind with other limits: start over
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, size)
+                    os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.key_slots, self.prefix_slots, 0), 0)
+            self.table = mmap.mmap(self.fd, size)
+
+        # Per worker: names of the prefixes this worker has seen (for stats),
+        # rejections, and distinct rejected keys of prefixes that are full
+        self.names = {}
+        self.distinct = {}
+        self.rejected = {}
+        self.rejected_total = 0
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            if self.fd is None:
+                yield
+                return
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def prefix(self, key):
+        return ".".join(key.split(".", self.prefix_depth)[:self.prefix_depth])
+
+    def find_key(self, hashed):
+        # Slot offset holding `hashed`, or the empty slot where it would go
+        mask = self.key_slots - 1
+        index = hashed & mask
+        while True:
+            offset = self.keys_offset + index * 8
+            value = UINT64.unpack_from(self.table, offset)[0]
+            if value == hashed or value == 0:
+                return offset, value == hashed
+            index = (index + 1) & mask
+
+    def find_prefix(self, hashed):
+        mask = self.prefix_slots - 1
+        index = hashed & mask
+        while True:
+            offset = self.prefixes_offset + index * 16
+            value = UINT64.unpack_from(self.table, offset)[0]
+            if value == hashed or value == 0:
+                return offset, value == hashed
+            index = (index + 1) & mask
+
+    def allowed(self, key):
+        if self.allow is not None and self.allow.match(key):
+            return True
+
+        hashed = key_hash(key) or 1
+        if self.find_key(hashed)[1]:
+            return True
+
+        prefix = self.prefix(key)
+        prefix_hashed = key_hash(prefix) or 1
+        with self.locked():
+            prefix_offset, found = self.find_prefix(prefix_hashed)
+            if not found:
+                prefixes = UINT64.unpack_from(self.table, 24)[0]
+                if prefixes >= self.max_prefixes:
+                    return self.reject("other")
+                UINT64.pack_into(self.table, prefix_offset, prefix_hashed)
+                UINT64.pack_into(self.table, 24, prefixes + 1)
+            if len(self.names) < self.max_prefixes:
+                self.names.setdefault(prefix_hashed, prefix)
+
+            # Another worker or thread may have admitted it meanwhile
+            key_offset, found = self.find_key(hashed)
+            if found:
+                return True
+            count = UINT64.unpack_from(self.table, prefix_offset + 8)[0]
+            if count < self.max_keys:
+                UINT64.pack_into(self.table, prefix_offset + 8, count + 1)
+                UINT64.pack_into(self.table, key_offset, hashed)
+                return True
+
+            if prefix not in self.distinct:
+                self.distinct[prefix] = HyperLogLog()
+            self.distinct[prefix].add(hashed)
+            return self.reject(prefix)
+
+    def reject(self, prefix):
+        self.rejected[prefix] = self.rejected.get(prefix, 0) + 1
+        self.rejected_total += 1
+        return False
+
+    def stats(self):
+        with self.lock:
+            saturated = {}
+            for prefix_hashed, prefix in self.names.items():
+                offset, _ = self.find_prefix(prefix_hashed)
+                admitted = UINT64.unpack_from(self.table, offset + 8)[0]
+                # Only the prefixes that are in trouble, the full list can be long
+                if admitted >= self.max_keys:
+                    rejected = self.distinct.get(prefix)
+                    saturated[prefix] = {
+                        "admitted": admitted,
+                        "distinct_seen": admitted + (round(rejected.estimate()) if rejected is not None else 0)
+                    }
+            return {
+                "prefixes": UINT64.unpack_from(self.table, 24)[0],
+                "rejected_total": self.rejected_total,
+                "rejected": dict(self.rejected),
+                "saturated": saturated
+            }
+
+
+class RateLimiter:
+    # Token bucket per client: `rate` metrics per second with bursts of up to
+    # `burst`. Clients are the services from the auth tokens file, so there
+    # are only ever a handful of buckets. Each of `workers` processes gets an
+    # equal share of both, which adds up to the configured limit as long as
+    # requests are spread over them. A batch bigger than the bucket is let
+    # through on a full bucket and paid back before the next one.
+
+    def __init__(self, rate, burst, workers=1):
+        self.rate = rate / workers
+        self.burst = burst / workers
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.limited = {}
+
+    def allow(self, client, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < min(cost, self.burst):
+                self.buckets[client] = (tokens, now)
+                self.limited[client] = self.limited.get(client, 0) + 1
+                return False
+            self.buckets[client] = (tokens - cost, now)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {"rate": self.rate, "burst": self.burst, "limited": dict(self.limited)}
@@ -0,0 +1,282 @@
+# Load test and benchmark for httpmetrics. Starts a UDP sink standing in for
+# graphite-statsd, runs the app under gunicorn pointed at it (unless --url is
+# given) and drives /mtx from a pool of keep-alive connections with a mix of
+# counters, timers and gauges named like the ones the service dashboards in
+# ../dashboards/services graph. Reports throughput, latency and how many
+# metrics made it to the sink.
+#
+#   python loadtest.py --duration 10 --concurrency 32
+#   python loadtest.py --rate 2000 --mix c=50,t=40,g=10 --distribution zipf --output baseline.json
+import argparse, base64, bisect, glob, http.client, itertools, json, os, random, re, socket, subprocess, sys, threading, time
+from urllib.parse import quote, urlsplit
+
+SECRET = "loadtest"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Values for the template variables and wildcards in dashboard targets
+ENVIRONMENTS = ("production", "staging")
+WILDCARDS = ("200", "201", "304", "400", "404", "500", "get", "post", "success", "error", "react", "query", "refresh")
+
+
+class UDPSink:
+    # Counts datagrams and the statsd lines inside them
+    def __init__(self, host="127.0.0.1", port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind((host, port))
+        self.sock.settimeout(0.2)
+        self.port = self.sock.getsockname()[1]
+        self.packets = 0
+        self.lines = 0
+        self.types = dict.fromkeys(("c", "ms", "g"), 0)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65535)
+            except socket.timeout:
+                continue
+            self.packets += 1
+            for line in data.split(b"\n"):
+                self.lines += 1
+                typ = line.split(b"|")[1].decode() if b"|" in line else "?"
+                self.types[typ] = self.types.get(typ, 0) + 1
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+def dashboard_keys(directory):
+    # Turns graphite targets like stats.timers.$env.slashz.http.response.*.mean
+    # into statsd (type, key) pairs: stats.timers.* are timers, stats.gauges.*
+    # gauges and the rest of stats.* / stats_counts.* (or *.) counters
+    templates = set()
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        with open(path) as f:
+            text = f.read()
+        for target in re.findall(r'"target":\s*"((?:[^"\\]|\\.)*)"', text):
+            for path_expression in re.findall(r"[\w$*\-]+(?:\.[\w$*\-]+)+", target):
+                template = statsd_template(path_expression)
+                if template is not None:
+                    templates.add(template)
+    return sorted(templates)
+
+
+def statsd_template(path_expression):
+    parts = path_expression.split(".")
+    if parts[0] not in ("stats", "stats_counts", "*") or parts[1:2] == ["statsd"]:
+        return None
+    if parts[1] == "timers":
+        typ, parts = "t", parts[2:]
+        # Drop the aggregate statsd adds (mean, upper_90, ...)
+        if parts and (parts[-1] in ("mean", "upper", "lower", "count", "sum", "median") or parts[-1].startswith("upper_")):
+            parts = parts[:-1]
+    elif parts[1] == "gauges":
+        typ, parts = "g", parts[2:]
+    else:
+        typ, parts = "c", parts[1:]
+    if len(parts) < 2:
+        return None
+    return typ, ".".join(parts)
+
+
+def expand(templates, variants, rng):
+    # Up to `variants` concrete keys per template, filling in $variables and wildcards
+    keys = []
+    for typ, template in templates:
+        seen = set()
+        for _ in range(variants):
+            key = ".".join(
+                rng.choice(ENVIRONMENTS) if part.startswith("$") else rng.choice(WILDCARDS) if part == "*" else part
+                for part in template.split(".")
+            )
+            if key not in seen:
+                seen.add(key)
+                keys.append((typ, key))
+    return keys
+
+
+class Workload:
+    # Picks the metric type by the --mix weights, then a key of that type
+    # either uniformly or zipf-distributed (a few hot keys, a long tail)
+    def __init__(self, keys, mix, distribution, zipf_s):
+        self.types = [typ for typ in ("c", "t", "g") if mix.get(typ) and any(t == typ for t, _ in keys)]
+        self.type_weights = list(itertools.accumulate(mix[typ] for typ in self.types))
+        self.keys = {typ: [key for t, key in keys if t == typ] for typ in self.types}
+        self.key_weights = {}
+        for typ, typ_keys in self.keys.items():
+            weights = [1.0 / (rank + 1) ** zipf_s if distribution == "zipf" else 1.0 for rank in range(len(typ_keys))]
+            self.key_weights[typ] = list(itertools.accumulate(weights))
+
+    def path(self, rng):
+        typ = self.types[bisect.bisect(self.type_weights, rng.random() * self.type_weights[-1])]
+        weights = self.key_weights[typ]
+        key = self.keys[typ][bisect.bisect(weights, rng.random() * weights[-1])]
+        if typ == "t":
+            value = int(rng.lognormvariate(3.5, 0.8))
+        elif typ == "g":
+            value = rng.randrange(100)
+        else:
+            value = 1
+        return "/mtx?k=%s&t=%s&v=%d" % (quote(key), typ, value)
+
+
+def start_server(sink_port, port, env=None):
+    env = dict(os.environ, GRAPHITE="127.0.0.1", STATSD_PORT=str(sink_port), BASIC_HTTP_AUTH_SECRET=SECRET, **(env or {}))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", "127.0.0.1:%d" % port, "app:app"],
+        cwd=HERE,
+        env=env
+    )
+    # Wait for the port to open
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("httpmetrics did not start")
+
+
+def worker(url, auth, workload, interval, deadline, results, index):
+    # With a target rate each worker sends on a fixed schedule and latency is
+    # counted from when the request was due, so a stalled server can't hide
+    # behind the requests it kept us from sending
+    parts = urlsplit(url)
+    conn_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    conn = conn_class(parts.hostname, parts.port, timeout=10)
+    headers = {"Authorization": auth, "Content-Length": "0"}
+    rng = random.Random(index)
+    latencies, errors = results["latencies"], results["errors"]
+    due = time.perf_counter() + rng.random() * interval
+    while True:
+        if interval:
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        start = due if interval else time.perf_counter()
+        if start >= deadline:
+            break
+        due += interval
+
+        try:
+            conn.request("POST", workload.path(rng), headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException):
+            errors.append(None)
+            conn.close()
+            conn = conn_class(parts.hostname, parts.port, timeout=10)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        typ, _, weight = part.partition("=")
+        mix[typ.strip()] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test httpmetrics /mtx")
+    parser.add_argument("--url", default=None, help="Test an already running server instead of starting one")
+    parser.add_argument("--secret", default=SECRET, help="BASIC_HTTP_AUTH_SECRET of the server under test")
+    parser.add_argument("--port", type=int, default=8199, help="Port for the server started by the load test")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=0, help="Target requests/second over all connections, 0 for as fast as possible")
+    parser.add_argument("--mix", type=parse_mix, default="c=60,t=30,g=10", help="Weights of counters, timers and gauges")
+    parser.add_argument("--distribution", choices=("uniform", "zipf"), default="zipf", help="How often each key is picked")
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--variants", type=int, default=5, help="Concrete keys generated per dashboard target")
+    parser.add_argument("--dashboards", default=os.path.join(HERE, "..", "dashboards", "services"))
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE for the started server, e.g. AGGREGATE=1")
+    parser.add_argument("--output", default=None, help="Also write the results as JSON here, as a baseline to compare against")
+    args = parser.parse_args()
+
+    keys = expand(dashboard_keys(args.dashboards), args.variants, random.Random(0))
+    if not keys:
+        parser.error("no statsd keys found in %s" % args.dashboards)
+    workload = Workload(keys, args.mix, args.distribution, args.zipf_s)
+
+    sink = None
+    server = None
+    url = args.url
+    if url is None:
+        sink = UDPSink()
+        server = start_server(sink.port, args.port, dict(pair.split("=", 1) for pair in args.env))
+        url = "http://127.0.0.1:%d" % args.port
+
+    auth = "Basic " + base64.b64encode(("hackclub:" + args.secret).encode()).decode()
+    results = {"latencies": [], "errors": []}
+    interval = args.concurrency / args.rate if args.rate else 0
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(url, auth, workload, interval, deadline, results, i))
+        for i in range(args.concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if server is not None:
+        # Stopping gunicorn lets the workers send what they still have queued
+        server.terminate()
+        server.wait()
+    time.sleep(0.3)
+    if sink is not None:
+        sink.stop()
+
+    latencies = sorted(results["latencies"])
+    report = {
+        "keys": len(keys),
+        "requests": len(latencies),
+        "errors": len(results["errors"]),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "target_rate": args.rate or None,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p90": round(percentile(latencies, 90) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round((latencies[-1] if latencies else 0) * 1000, 3)
+        }
+    }
+    print("keys:       %d from %s" % (len(keys), os.path.normpath(args.dashboards)))
+    print("requests:   %d in %.1fs (%.0f req/s), %d errors" % (len(latencies), elapsed, len(latencies) / elapsed, len(results["errors"])))
+    print("latency:    p50 %(p50).2fms  p90 %(p90).2fms  p99 %(p99).2fms  max %(max).2fms" % report["latency_ms"])
+    if sink is not None:
+        # Only meaningful without AGGREGATE=1, which folds metrics together on purpose
+        lost = max(len(latencies) - sink.lines, 0)
+        report.update(packets=sink.packets, delivered=sink.lines, lost=lost, loss=round(lost / max(len(latencies), 1), 5))
+        print("udp sink:   %d packets, %d metrics (%d counters, %d timers, %d gauges), %d lost (%.3f%%)" % (
+            sink.packets, sink.lines, sink.types["c"], sink.types["ms"], sink.types["g"], lost, report["loss"] * 100
+        ))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
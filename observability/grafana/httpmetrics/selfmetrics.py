@@ -0,0 +1,189 @@
+import atexit, bisect, json, os, threading, time
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class SelfMetrics:
+    # httpmetrics' own counters, gauges and histograms, kept in plain dicts
+    # keyed by (name, labels). The number of series is capped: once
+    # max_series is reached new label combinations are folded into one
+    # "other" series per metric, so a client can't grow this without bound.
+    #
+    # Under gunicorn each worker only sees its own requests. When a directory
+    # is given every worker writes its snapshot there every few seconds and
+    # render() merges all of them, like prometheus_client's multiprocess mode.
+
+    def __init__(self, max_series=1000, directory=None, write_interval=5.0):
+        self.max_series = max_series
+        self.directory = directory
+        self.write_interval = write_interval
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.help = {}
+        self.values = {}
+        self.histograms = {}
+        self.dropped_series = 0
+        self.collectors = []
+        self.pid = None
+
+    def describe(self, name, kind, text):
+        self.kinds[name] = kind
+        self.help[name] = text
+
+    def add_collector(self, collector):
+        # Called before every snapshot to copy in values tracked elsewhere
+        self.collectors.append(collector)
+
+    def series(self, table, name, labels):
+        key = (name, labels)
+        if key in table or len(self.values) + len(self.histograms) < self.max_series:
+            return key
+        self.dropped_series += 1
+        return (name, tuple((label, "other") for label, _ in labels))
+
+    def inc(self, name, labels=(), value=1):
+        self.ensure_writer()
+        with self.lock:
+            key = self.series(self.values, name, labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[self.series(self.values, name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        self.ensure_writer()
+        with self.lock:
+            key = self.series(self.histograms, name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            histogram[1] += value
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector(self)
+        with self.lock:
+            return {
+                "values": [[name, list(labels), value] for (name, labels), value in self.values.items()],
+                "histograms": [[name, list(labels), list(h[0]), h[1]] for (name, labels), h in self.histograms.items()],
+                "dropped_series": self.dropped_series
+            }
+
+    def ensure_writer(self):
+        # Started lazily so the thread belongs to the forked worker
+        if self.directory is None or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self.run_writer, name="selfmetrics", daemon=True).start()
+        atexit.register(self.write)
+
+    def run_writer(self):
+        while True:
+            time.sleep(self.write_interval)
+            self.write()
+
+    def write(self):
+        path = os.path.join(self.directory, "%d.json" % os.getpid())
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def snapshots(self):
+        own = self.snapshot()
+        if self.directory is None or not os.path.isdir(self.directory):
+            return [own]
+        snapshots = [own]
+        # Files of exited workers stay, their counts are still part of the totals.
+        # Their gauges aren't: a worker gunicorn killed while its backend was
+        # down would report it down forever.
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json") and filename != "%d.json" % os.getpid():
+                try:
+                    pid = int(filename[:-len(".json")])
+                    with open(os.path.join(self.directory, filename)) as f:
+                        snapshot = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                snapshot["alive"] = pid_alive(pid)
+                snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        values = {}
+        histograms = {}
+        dropped = 0
+        for snapshot in self.snapshots():
+            dropped += snapshot["dropped_series"]
+            for name, labels, value in snapshot["values"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                if self.kinds.get(name) == "gauge":
+                    if not snapshot.get("alive", True):
+                        continue
+                    # Per-worker gauges (e.g. flush lag): report the worst one
+                    values[key] = max(values.get(key, value), value)
+                else:
+                    values[key] = values.get(key, 0) + value
+            for name, labels, buckets, total in snapshot["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+
+        for (name, labels), value in sorted(values.items()):
+            header(name, self.kinds.get(name, "counter"))
+            lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+
+        for (name, labels), (buckets, total) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", le),)), cumulative))
+            lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(total)))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), cumulative))
+
+        header("httpmetrics_selfmetrics_dropped_series_total", "counter")
+        lines.append("httpmetrics_selfmetrics_dropped_series_total %d" % dropped)
+        return "\n".join(lines) + "\n"
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,68 @@
+import math
+
+
+class LogSketch:
+    # Timer samples folded into logarithmic buckets, each one
+    # (1 + relative_accuracy) / (1 - relative_accuracy) times wider than the
+    # last (the DDSketch layout). Any percentile read back is within
+    # relative_accuracy of the real one, a few hundred buckets cover
+    # microseconds to hours, and two sketches merge by adding their counts.
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def state(self):
+        # Plain lists and numbers, for handing a sketch to another process as JSON
+        return [self.zeros, self.count, self.total, self.min, self.max, sorted(self.buckets.items())]
+
+    @classmethod
+    def from_state(cls, state, relative_accuracy=0.01):
+        sketch = cls(relative_accuracy)
+        sketch.zeros, sketch.count, sketch.total, sketch.min, sketch.max, buckets = state
+        sketch.buckets = {index: count for index, count in buckets}
+        return sketch
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return max(self.min, 0)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # The middle of the bucket (in relative terms) is closest to everything in it
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
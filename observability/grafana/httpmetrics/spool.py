@@ -0,0 +1,187 @@
+import fcntl, os, time
+
+
+class Spool:
+    # Append-only segment files of statsd lines, for metrics a backend can't
+    # take right now. Segments are named by creation time so sorting them by
+    # name replays in order; a segment is deleted once it has been read to the
+    # end. When the spool grows past max_bytes the oldest segments are
+    # deleted (and their lines counted as dropped) to make room.
+    #
+    # Each process spools to its own <directory>/<pid>. Directories left by
+    # processes that are gone are adopted on open, so a restart loses nothing;
+    # the workers of a restarted server all try at once, so adopting happens
+    # under an flock. How far the oldest segment has been replayed is kept in
+    # <directory>/<pid>/offset, and an adopted segment is cut down to what
+    # was left of it, so nothing is replayed twice.
+
+    def __init__(self, directory, segment_bytes=4 << 20, max_bytes=256 << 20):
+        self.base = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.pid = None
+        self.directory = None
+        self.segments = []
+        self.bytes = 0
+        self.writer = None
+        self.written = 0
+        self.offset = 0
+        self.dropped = 0
+        self.last_name = 0
+
+    def open(self):
+        if self.pid == os.getpid():
+            return
+        self.directory = os.path.join(self.base, str(os.getpid()))
+        os.makedirs(self.directory, exist_ok=True)
+        self.writer = None
+        self.offset = 0
+
+        with open(os.path.join(self.base, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for name in os.listdir(self.base):
+                orphan = os.path.join(self.base, name)
+                if name.isdigit() and orphan != self.directory and not process_alive(int(name)):
+                    self.adopt(orphan)
+
+        self.segments = sorted(
+            os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".seg")
+        )
+        self.bytes = sum(os.path.getsize(segment) for segment in self.segments)
+        # A directory of our own left behind by an earlier process with the same pid
+        saved = read_offset(self.directory)
+        if saved is not None and self.segments and os.path.basename(self.segments[0]) == saved[0]:
+            self.offset = saved[1]
+        self.pid = os.getpid()
+
+    def adopt(self, orphan):
+        try:
+            saved = read_offset(orphan)
+            for segment in os.listdir(orphan):
+                if not segment.endswith(".seg"):
+                    continue
+                source = os.path.join(orphan, segment)
+                target = os.path.join(self.directory, segment)
+                if saved is not None and saved[0] == segment and saved[1] > 0:
+                    # Partly replayed: keep only the rest
+                    with open(source, "rb") as f:
+                        f.seek(saved[1])
+                        rest = f.read()
+                    with open(target + ".tmp", "wb") as f:
+                        f.write(rest)
+                    os.replace(target + ".tmp", target)
+                    os.remove(source)
+                else:
+                    os.rename(source, target)
+            for name in os.listdir(orphan):
+                os.remove(os.path.join(orphan, name))
+            os.rmdir(orphan)
+        except FileNotFoundError:
+            # Taken over by a process that doesn't lock, whatever is left is its
+            pass
+
+    def append(self, lines):
+        self.open()
+        data = ("\n".join(lines) + "\n").encode("ascii")
+        if self.writer is None or self.written + len(data) > self.segment_bytes:
+            self.roll()
+        self.writer.write(data)
+        # Flushed every time so the reader and a restarted process see it
+        self.writer.flush()
+        self.written += len(data)
+        self.bytes += len(data)
+
+        while self.bytes > self.max_bytes and len(self.segments) > 1:
+            self.drop_oldest()
+
+    def roll(self):
+        if self.writer is not None:
+            self.writer.close()
+        # Names have to keep increasing even if two segments start in the same tick
+        self.last_name = max(self.last_name + 1, time.time_ns())
+        path = os.path.join(self.directory, "%020d.seg" % self.last_name)
+        self.writer = open(path, "ab")
+        self.written = 0
+        self.segments.append(path)
+
+    def drop_oldest(self):
+        path = self.segments.pop(0)
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            self.dropped += f.read().count(b"\n")
+        self.bytes -= os.path.getsize(path)
+        os.remove(path)
+        self.offset = 0
+        self.save_offset()
+
+    def pending(self):
+        self.open()
+        return self.bytes - self.offset > 0
+
+    def peek(self, max_lines):
+        # Up to max_lines from the oldest segment, and where reading stopped.
+        # Nothing is consumed until advance() is called with that position.
+        self.open()
+        if not self.segments:
+            return [], 0
+        lines = []
+        with open(self.segments[0], "rb") as f:
+            f.seek(self.offset)
+            position = self.offset
+            while len(lines) < max_lines:
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break
+                position += len(line)
+                lines.append(line[:-1].decode("ascii"))
+        return lines, position
+
+    def advance(self, position):
+        path = self.segments[0]
+        self.offset = position
+        if self.offset < os.path.getsize(path):
+            self.save_offset()
+            return
+        # Read to the end, the segment can go
+        if self.writer is not None and self.writer.name == path:
+            self.writer.close()
+            self.writer = None
+        self.segments.pop(0)
+        self.bytes -= self.offset
+        os.remove(path)
+        self.offset = 0
+        self.save_offset()
+
+    def save_offset(self):
+        path = os.path.join(self.directory, "offset")
+        if self.offset == 0 or not self.segments:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with open(path + ".tmp", "w") as f:
+            f.write("%s %d\n" % (os.path.basename(self.segments[0]), self.offset))
+        os.replace(path + ".tmp", path)
+
+    def stats(self):
+        return {"segments": len(self.segments), "bytes": self.bytes - self.offset, "dropped": self.dropped}
+
+
+def read_offset(directory):
+    # (segment name, offset) saved by save_offset(), or None
+    try:
+        with open(os.path.join(directory, "offset")) as f:
+            name, offset = f.read().split()
+        return name, int(offset)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
@@ -0,0 +1,49 @@
+# Value validation on /mtx and /mtx/batch: python -m pytest test_app.py
+import base64, os, socket
+
+with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    sock.bind(("127.0.0.1", 0))
+    os.environ.setdefault("FORWARD_TO", "udp://127.0.0.1:%d" % sock.getsockname()[1])
+os.environ.setdefault("BASIC_HTTP_AUTH_SECRET", "secret")
+
+import app
+
+AUTH = {"Authorization": "Basic " + base64.b64encode(b"hackclub:" + os.environ["BASIC_HTTP_AUTH_SECRET"].encode()).decode()}
+
+
+def post(path, **kwargs):
+    return app.app.test_client().post(path, headers=AUTH, **kwargs)
+
+
+def test_values_are_parsed_the_same_way_everywhere():
+    assert app.parse_value("t", "3") == 3
+    assert app.parse_value("t", 3.0) == 3
+    assert app.parse_value("c", "1.5") == 1.5
+    assert app.parse_value("g", -2) == -2.0
+    for typ, value in (("t", 2.7), ("t", "1.5"), ("c", True), ("t", False), ("c", "nan"), ("g", "inf"), ("g", float("-inf")), ("t", float("nan"))):
+        try:
+            app.parse_value(typ, value)
+        except ValueError:
+            continue
+        raise AssertionError("%s %r was accepted" % (typ, value))
+
+
+def test_mtx_rejects_fractional_timers_and_non_finite_values():
+    assert post("/mtx?k=test.app.t&t=t&v=12").status_code == 200
+    assert post("/mtx?k=test.app.t&t=t&v=1.5").status_code == 400
+    assert post("/mtx?k=test.app.c&t=c&v=nan").status_code == 400
+    assert post("/mtx?k=test.app.g&t=g&v=inf").status_code == 400
+
+
+def test_json_batch_rejects_booleans_fractional_timers_and_non_finite_values():
+    for item in ('{"k":"test.app.t","t":"t","v":2.7}', '{"k":"test.app.c","t":"c","v":true}', '{"k":"test.app.g","t":"g","v":1e999}'):
+        response = post("/mtx/batch", data="[%s]" % item, content_type="application/json")
+        assert response.status_code == 400, item
+    response = post("/mtx/batch", data='[{"k":"test.app.t","t":"t","v":3.0},{"k":"test.app.c","t":"c","v":2}]', content_type="application/json")
+    assert response.status_code == 200
+
+
+def test_line_batch_rejects_non_finite_values():
+    assert post("/mtx/batch", data="test.app.c:nan|c\n", content_type="text/plain").status_code == 400
+    assert post("/mtx/batch", data="test.app.t:2.5|t\n", content_type="text/plain").status_code == 400
+    assert post("/mtx/batch", data="test.app.c:1|c\ntest.app.t:7|t\n", content_type="text/plain").status_code == 200
@@ -0,0 +1,201 @@
+# Backends against real sockets on localhost: python -m pytest test_forwarder.py
+import socket, threading, time
+from forwarder import Forwarder, StatsdTCP, StatsdUDP
+from spool import Spool
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class UDPListener:
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.packets = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                self.packets.append(self.sock.recv(65535))
+            except socket.timeout:
+                pass
+
+    def lines(self):
+        return [line.decode() for packet in self.packets for line in packet.split(b"\n")]
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+
+class TCPListener:
+    def __init__(self, port=0, reply=None):
+        self.server = socket.create_server(("127.0.0.1", port))
+        self.port = self.server.getsockname()[1]
+        self.reply = reply
+        self.data = b""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                chunk = conn.recv(65535)
+                if not chunk:
+                    return
+                if self.reply is not None:
+                    conn.sendall(self.reply)
+                else:
+                    self.data += chunk
+
+    def lines(self):
+        return self.data.decode().splitlines()
+
+    def close(self):
+        self.server.close()
+
+
+def fast(backend):
+    backend.poll_interval = 0.05
+    backend.replay_poll_interval = 0.01
+    return backend
+
+
+def test_udp_delivers_in_packets_under_max_size():
+    listener = UDPListener()
+    backend = StatsdUDP("127.0.0.1", listener.port, admin_port=free_port())
+    forwarder = Forwarder([backend])
+    with forwarder.pipeline() as pipe:
+        for i in range(200):
+            pipe.incr("test.udp.key%d" % i)
+    assert wait_for(lambda: len(listener.lines()) == 200)
+    assert wait_for(lambda: backend.stats()["sent"] == 200)
+    listener.close()
+    assert listener.lines() == ["test.udp.key%d:1|c" % i for i in range(200)]
+    assert all(len(packet) <= 512 for packet in listener.packets)
+
+
+def test_tcp_delivers_lines():
+    listener = TCPListener()
+    backend = StatsdTCP("127.0.0.1", listener.port)
+    forwarder = Forwarder([backend])
+    forwarder.incr("test.tcp.count", 2)
+    forwarder.gauge("test.tcp.gauge", -3)
+    forwarder.timing("test.tcp.time", 12, rate=0.5)
+    assert wait_for(lambda: len(listener.lines()) == 4)
+    listener.close()
+    assert listener.lines() == [
+        "test.tcp.count:2|c",
+        "test.tcp.gauge:0|g",
+        "test.tcp.gauge:-3|g",
+        "test.tcp.time:12.000000|ms|@0.5",
+    ]
+
+
+def test_non_ascii_key_is_dropped_and_the_backend_keeps_sending():
+    listener = UDPListener()
+    backend = StatsdUDP("127.0.0.1", listener.port, admin_port=free_port())
+    backend.put(["héllo:1|c"])
+    backend.put(["ok.key:1|c"])
+    assert wait_for(lambda: listener.lines() == ["ok.key:1|c"])
+    assert wait_for(lambda: backend.stats()["sent"] == 1)
+    listener.close()
+    stats = backend.stats()
+    assert stats["dropped"] == 1 and stats["sent"] == 1 and stats["queued"] == 0
+
+
+def test_unexpected_error_does_not_stop_the_sender():
+    listener = UDPListener()
+    backend = StatsdUDP("127.0.0.1", listener.port, admin_port=free_port())
+    send = backend.send
+    failures = []
+
+    def failing_send(lines):
+        if not failures:
+            failures.append(lines)
+            raise ValueError("broken")
+        send(lines)
+
+    backend.send = failing_send
+    backend.put(["first:1|c"])
+    assert wait_for(lambda: failures)
+    backend.put(["second:1|c"])
+    assert wait_for(lambda: listener.lines() == ["second:1|c"])
+    assert wait_for(lambda: backend.stats()["sent"] == 1)
+    listener.close()
+    stats = backend.stats()
+    assert stats["errors"] == 1 and stats["dropped"] == 1 and stats["sent"] == 1
+
+
+def test_backend_down_without_spool_drops_and_counts():
+    backend = StatsdTCP("127.0.0.1", free_port(), timeout=0.5)
+    backend.put(["lost:1|c"])
+    assert wait_for(lambda: backend.stats()["dropped"] == 1)
+    assert backend.stats()["errors"] == 1
+    assert backend.stats()["sent"] == 0
+
+
+def test_tcp_backend_down_spools_and_replays_in_order(tmp_path):
+    port = free_port()
+    backend = fast(StatsdTCP(
+        "127.0.0.1", port, timeout=0.5, retry_interval=0.05,
+        spool=Spool(str(tmp_path)), health_interval=0.05, replay_rate=10000
+    ))
+    for i in range(50):
+        backend.put(["spooled.%d:1|c" % i])
+    assert wait_for(lambda: backend.stats()["spooled"] == 50)
+    assert backend.stats()["down"]
+
+    listener = TCPListener(port)
+    assert wait_for(lambda: len(listener.lines()) == 50)
+    listener.close()
+    assert listener.lines() == ["spooled.%d:1|c" % i for i in range(50)]
+    assert wait_for(lambda: backend.stats()["replayed"] == 50)
+    stats = backend.stats()
+    assert not stats["down"] and stats["spool"]["bytes"] == 0
+
+
+def test_udp_backend_uses_the_admin_port_for_health(tmp_path):
+    listener = UDPListener()
+    admin = TCPListener(reply=b"health: down\n")
+    backend = fast(StatsdUDP(
+        "127.0.0.1", listener.port, admin_port=admin.port,
+        spool=Spool(str(tmp_path)), health_interval=0.05, replay_rate=10000
+    ))
+    # UDP sends never fail, so mark it down like a failed health check would
+    backend.down = True
+    backend.put(["held:1|c"])
+    assert wait_for(lambda: backend.stats()["spooled"] == 1)
+    time.sleep(0.2)
+    assert listener.lines() == []
+
+    admin.reply = b"health: up\n"
+    assert wait_for(lambda: listener.lines() == ["held:1|c"])
+    listener.close()
+    admin.close()
@@ -0,0 +1,41 @@
+# Merging worker snapshots: python -m pytest test_selfmetrics.py
+import json, os, subprocess, sys
+from selfmetrics import SelfMetrics
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def worker_file(directory, pid, values):
+    with open(os.path.join(directory, "%d.json" % pid), "w") as f:
+        json.dump({"values": values, "histograms": [], "dropped_series": 0}, f)
+
+
+def metrics(directory):
+    metrics = SelfMetrics(directory=str(directory))
+    metrics.describe("test_requests_total", "counter", "Requests")
+    metrics.describe("test_forward_down", "gauge", "Backend down")
+    return metrics
+
+
+def test_counters_of_dead_workers_stay_and_their_gauges_go(tmp_path):
+    worker_file(tmp_path, dead_pid(), [["test_requests_total", [], 5], ["test_forward_down", [], 1]])
+    # The parent of the test run stands in for a live worker
+    worker_file(tmp_path, os.getppid(), [["test_requests_total", [], 2], ["test_forward_down", [], 0]])
+
+    own = metrics(tmp_path)
+    own.set("test_forward_down", 0)
+    own.values[("test_requests_total", ())] = 1
+    lines = own.render().splitlines()
+    assert "test_requests_total 8" in lines
+    assert "test_forward_down 0" in lines
+
+
+def test_gauges_of_live_workers_report_the_worst(tmp_path):
+    worker_file(tmp_path, os.getppid(), [["test_forward_down", [], 1]])
+    own = metrics(tmp_path)
+    own.set("test_forward_down", 0)
+    assert "test_forward_down 1" in own.render().splitlines()
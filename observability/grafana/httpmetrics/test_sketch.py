@@ -0,0 +1,108 @@
+# python -m pytest test_sketch.py
+import json, random
+from aggregator import Aggregator
+from sketch import LogSketch
+
+PERCENTILES = (0, 1, 10, 25, 50, 75, 90, 95, 99, 99.9, 100)
+
+
+def exact(sorted_values, q):
+    # The sample at the same rank LogSketch.quantile looks for
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+
+def samples(distribution, count, seed=0):
+    rng = random.Random(seed)
+    if distribution == "lognormal":
+        return [rng.lognormvariate(3.5, 0.8) for _ in range(count)]
+    if distribution == "uniform":
+        return [rng.uniform(0.5, 2000) for _ in range(count)]
+    if distribution == "bimodal":
+        return [rng.gauss(5, 1) if rng.random() < 0.9 else rng.gauss(900, 50) for _ in range(count)]
+    # Whole milliseconds with many repeats, like the timers /mtx gets
+    return [int(rng.expovariate(1 / 40)) + 1 for _ in range(count)]
+
+
+def check_accuracy(sketch, values, accuracy):
+    values = sorted(values)
+    for percentile in PERCENTILES:
+        want = exact(values, percentile / 100)
+        got = sketch.quantile(percentile / 100)
+        assert abs(got - want) <= accuracy * abs(want) + 1e-9, (percentile, got, want)
+
+
+def test_quantiles_are_within_relative_accuracy_of_sorted_samples():
+    for distribution in ("lognormal", "uniform", "bimodal", "integers"):
+        for accuracy in (0.01, 0.02, 0.05):
+            values = samples(distribution, 20000)
+            sketch = LogSketch(accuracy)
+            for value in values:
+                sketch.add(value)
+            check_accuracy(sketch, values, accuracy)
+            assert sketch.count == len(values)
+            assert sketch.max == max(values)
+            assert abs(sketch.mean() - sum(values) / len(values)) < 1e-6 * sketch.mean()
+
+
+def test_zeros_and_small_counts():
+    sketch = LogSketch()
+    assert sketch.quantile(0.5) is None
+    for value in (0, 0, 0, 10):
+        sketch.add(value)
+    assert sketch.quantile(0.5) == 0
+    assert sketch.quantile(1) == 10
+
+
+def test_merged_sketches_match_one_sketch_of_everything():
+    parts = [samples("lognormal", 5000, seed) for seed in range(4)]
+    merged = LogSketch()
+    for part in parts:
+        sketch = LogSketch()
+        for value in part:
+            sketch.add(value)
+        # Through JSON, the way workers hand them over
+        merged.merge(LogSketch.from_state(json.loads(json.dumps(sketch.state()))))
+    values = [value for part in parts for value in part]
+    check_accuracy(merged, values, 0.01)
+    assert merged.count == len(values)
+
+
+class RecordingClient:
+    def __init__(self):
+        self.lines = {}
+
+    def pipeline(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def incr(self, key, value):
+        self.lines[key] = self.lines.get(key, 0) + value
+
+    def gauge(self, key, value):
+        assert key not in self.lines, "%s sent twice, statsd would keep only one" % key
+        self.lines[key] = value
+
+
+def test_workers_send_percentiles_of_all_their_samples(tmp_path):
+    client = RecordingClient()
+    workers = [Aggregator(client, timer_mode="sketch", percentiles=(50, 99), sketch_dir=str(tmp_path)) for _ in range(3)]
+    values = samples("integers", 6000)
+    for i, value in enumerate(values):
+        # Skip ensure_started, the test flushes by hand
+        workers[i % 3].timers.setdefault("svc.latency", LogSketch()).add(value)
+    workers[0].flush()
+    workers[1].flush()
+    workers[2].flush(True)
+
+    values.sort()
+    assert client.lines["svc.latency.count"] == len(values)
+    assert client.lines["svc.latency.max"] == values[-1]
+    for percentile in (50, 99):
+        want = exact(values, percentile / 100)
+        assert abs(client.lines["svc.latency.p%d" % percentile] - want) <= 0.01 * want + 0.001
+    assert not list(tmp_path.glob("*.json"))
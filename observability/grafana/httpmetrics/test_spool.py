@@ -0,0 +1,84 @@
+# python -m pytest test_spool.py
+import multiprocessing, os, subprocess, sys
+from spool import Spool
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def spool_in_dead_process(directory, lines, replayed):
+    # Spools `lines` and replays the first `replayed` of them in a process that then exits
+    code = (
+        "from spool import Spool\n"
+        "spool = Spool(%r)\n"
+        "spool.append(%r)\n"
+        "lines, position = spool.peek(%d)\n"
+        "spool.advance(position)\n"
+    ) % (directory, lines, replayed)
+    subprocess.run([sys.executable, "-c", code], cwd=HERE, check=True)
+
+
+def replay_all(directory, results):
+    spool = Spool(directory)
+    lines = []
+    while spool.pending():
+        batch, position = spool.peek(100)
+        spool.advance(position)
+        lines += batch
+    results.put(lines)
+
+
+def test_replay_is_in_order_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    for i in range(20):
+        spool.append(["key.%d:1|c" % i])
+    assert spool.stats()["segments"] > 1
+    replayed = []
+    while spool.pending():
+        lines, position = spool.peek(3)
+        spool.advance(position)
+        replayed += lines
+    assert replayed == ["key.%d:1|c" % i for i in range(20)]
+    assert spool.stats()["bytes"] == 0
+
+
+def test_adopted_spool_resumes_where_replay_stopped(tmp_path):
+    lines = ["key.%d:1|c" % i for i in range(10)]
+    spool_in_dead_process(str(tmp_path), lines, 4)
+
+    spool = Spool(str(tmp_path))
+    assert spool.pending()
+    replayed, position = spool.peek(100)
+    spool.advance(position)
+    assert replayed == lines[4:]
+    assert not spool.pending()
+
+
+def test_workers_starting_together_adopt_each_line_once(tmp_path):
+    lines = ["key.%d:1|c" % i for i in range(10)]
+    spool_in_dead_process(str(tmp_path), lines, 4)
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=replay_all, args=(str(tmp_path), results)) for _ in range(6)]
+    for worker in workers:
+        worker.start()
+    replayed = sorted(line for _ in workers for line in results.get(timeout=10))
+    for worker in workers:
+        worker.join()
+    assert [worker.exitcode for worker in workers] == [0] * 6
+    assert replayed == sorted(lines[4:])
+
+
+def test_oldest_segments_are_dropped_past_max_bytes(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=100, max_bytes=300)
+    for i in range(100):
+        spool.append(["key.%02d:1|c" % i])
+    stats = spool.stats()
+    assert stats["bytes"] <= 300 + 100
+    assert stats["dropped"] > 0
+    replayed = []
+    while spool.pending():
+        lines, position = spool.peek(100)
+        spool.advance(position)
+        replayed += lines
+    assert replayed[-1] == "key.99:1|c"
+    assert len(replayed) + stats["dropped"] == 100
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+This file benchmarks the `pull` command against the stub Grafana in `stub_grafana.py`.
+It times the old way of fetching (one fresh `requests.get` per dashboard, one after another),
+`pull` with a pooled session at a few concurrency levels, `pull --incremental` with nothing and with a few dashboards changed,
+and the old one-by-one `push` next to the batched one.
+With `--memory` it instead compares the peak memory of the old fetch-everything-then-save pull with the streaming one,
+against a stub running in its own process so only our allocations count.
+Run it with `python bench_pull.py --dashboards 300 --latency 0.02 --connect-delay 0.05`
+or `python bench_pull.py --memory --dashboards 3000`
+"""
+
+import argparse, json, os, shutil, socket, subprocess, sys, tempfile, time, tracemalloc, requests
+import src.grafana.dashboards as dashboards
+from src.cli.dashboards.pull import pull
+from src.cli.dashboards.push import push
+from src.utils import create_headers
+from stub_grafana import StubGrafana, serve, pull_args, push_args
+
+
+def push_sequential(INPUT: str):
+    """
+    This function pushes like `push` used to: one file after another, each read again for every step,
+    with an existence check, a fetch for the diff and an import per dashboard.
+    """
+    URL = os.environ["GRAFANA_URL"]
+    for PATH in [
+        os.path.join(ROOT, FILE)
+        for ROOT, _, FILES in os.walk(INPUT)
+        for FILE in FILES
+        if FILE.endswith(".json") and "dashboard" in json.load(open(os.path.join(ROOT, FILE)))
+    ]:
+        DASHBOARD = open(PATH).read()
+        UID = json.loads(DASHBOARD)["dashboard"]["uid"]
+        if dashboards.get_session().get(f"{URL}/api/dashboards/uid/{UID}").status_code != 404:
+            dashboards.get_dashboard(json.loads(DASHBOARD)["dashboard"])
+            dashboards.import_dashboard(json.loads(DASHBOARD), new=False)
+        else:
+            dashboards.import_dashboard(json.loads(DASHBOARD))
+
+
+def fetch_unpooled():
+    """
+    This function fetches every dashboard like `pull` used to: one after another, each with a new connection.
+    """
+    URL = os.environ["GRAFANA_URL"]
+    for DASHBOARD in requests.get(f"{URL}/api/search?query=&type=dash-db", headers=create_headers(True)).json():
+        requests.get(f"{URL}/api/dashboards/uid/{DASHBOARD['uid']}", headers=create_headers(True)).json()
+
+
+def pull_buffered(OUTPUT: str, CONCURRENCY: int):
+    """
+    This function pulls like `pull` did before it streamed: every dashboard is fetched into a list first,
+    then saved in a loop that finds each one with a linear `.index()` search.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    DASHBOARDS_METADATA = list(dashboards.get_dashboards())
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as EXECUTOR:
+        DASHBOARDS = list(EXECUTOR.map(dashboards.get_dashboard, DASHBOARDS_METADATA))
+    for DASHBOARD in DASHBOARDS_METADATA:
+        dashboards.save_dashboard(OUTPUT, DASHBOARD, DASHBOARDS[DASHBOARDS_METADATA.index(DASHBOARD)])
+
+
+def traced(LABEL: str, FUNCTION):
+    """
+    This function runs `FUNCTION` and prints how long it took and its peak Python memory use.
+    """
+    tracemalloc.start()
+    START = time.perf_counter()
+    FUNCTION()
+    ELAPSED = time.perf_counter() - START
+    _, PEAK = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{LABEL:<36} {ELAPSED:7.2f}s  peak {PEAK / 2**20:7.1f} MiB")
+
+
+def bench_memory(ARGS):
+    """
+    This function runs the `--memory` comparison against a stub Grafana in a subprocess.
+    """
+    with socket.socket() as SOCK:
+        SOCK.bind(("127.0.0.1", 0))
+        PORT = SOCK.getsockname()[1]
+    STUB = subprocess.Popen(
+        [
+            sys.executable,
+            "stub_grafana.py",
+            "--dashboards", str(ARGS.dashboards),
+            "--panels", str(ARGS.panels),
+            "--port", str(PORT),
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", PORT), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        os.environ["GRAFANA_URL"] = f"http://127.0.0.1:{PORT}"
+        CONCURRENCY = max(ARGS.concurrency)
+        print(f"{ARGS.dashboards} dashboards of {ARGS.panels} panels, concurrency {CONCURRENCY}")
+        for LABEL, FUNCTION in (
+            ("fetch all, then save (old)", lambda OUTPUT: pull_buffered(OUTPUT, CONCURRENCY)),
+            ("streaming pull", lambda OUTPUT: pull(pull_args(OUTPUT, CONCURRENCY))),
+        ):
+            OUTPUT = tempfile.mkdtemp()
+            dashboards.SESSION = None
+            traced(LABEL, lambda: FUNCTION(OUTPUT))
+            shutil.rmtree(OUTPUT)
+    finally:
+        STUB.terminate()
+
+
+def timed(LABEL: str, STUB: StubGrafana, FUNCTION):
+    """
+    This function runs `FUNCTION` and prints how long it took and which API calls it made.
+    """
+    STUB.requests.clear()
+    START = time.perf_counter()
+    FUNCTION()
+    ELAPSED = time.perf_counter() - START
+    CALLS = ", ".join(f"{COUNT} {ROUTE}" for ROUTE, COUNT in sorted(STUB.requests.items()))
+    print(f"{LABEL:<36} {ELAPSED:7.2f}s  {CALLS}")
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Benchmark dashboard-saver pull against a stub Grafana")
+    PARSER.add_argument("--dashboards", type=int, default=300)
+    PARSER.add_argument("--latency", type=float, default=0.02, help="Seconds per request")
+    PARSER.add_argument("--connect-delay", type=float, default=0.05, help="Seconds per new connection")
+    PARSER.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    PARSER.add_argument("--memory", action="store_true", help="Compare peak memory instead")
+    PARSER.add_argument("--panels", type=int, default=30, help="Panels per dashboard, with --memory")
+    ARGS = PARSER.parse_args()
+
+    os.environ["GRAFANA_APIKEY"] = "bench"
+    if ARGS.memory:
+        bench_memory(ARGS)
+        sys.exit()
+
+    STUB = StubGrafana(ARGS.dashboards)
+    SERVER = serve(STUB, LATENCY=ARGS.latency, CONNECT_DELAY=ARGS.connect_delay)
+    os.environ["GRAFANA_URL"] = f"http://127.0.0.1:{SERVER.server_port}"
+
+    print(f"{ARGS.dashboards} dashboards, {ARGS.latency * 1000:.0f}ms per request, {ARGS.connect_delay * 1000:.0f}ms per connection")
+    timed("unpooled, sequential (old)", STUB, fetch_unpooled)
+    for CONCURRENCY in ARGS.concurrency:
+        OUTPUT = tempfile.mkdtemp()
+        # A new session per run, sized for its concurrency
+        dashboards.SESSION = None
+        timed(f"pull --concurrency {CONCURRENCY}", STUB, lambda: pull(pull_args(OUTPUT, CONCURRENCY)))
+        shutil.rmtree(OUTPUT)
+
+    OUTPUT = tempfile.mkdtemp()
+    CONCURRENCY = max(ARGS.concurrency)
+    dashboards.SESSION = None
+    pull(pull_args(OUTPUT, CONCURRENCY))
+    timed("pull --incremental, nothing changed", STUB, lambda: pull(pull_args(OUTPUT, CONCURRENCY, True)))
+    for UID in list(STUB.dashboards)[:5]:
+        STUB.touch(UID)
+    timed("pull --incremental, 5 changed", STUB, lambda: pull(pull_args(OUTPUT, CONCURRENCY, True)))
+
+    for UID in list(STUB.dashboards)[5:10]:
+        STUB.touch(UID)
+    timed("push --dry-run, 5 changed", STUB, lambda: push(push_args(OUTPUT, CONCURRENCY, True)))
+    timed("push one by one (old)", STUB, lambda: push_sequential(OUTPUT))
+    pull(pull_args(OUTPUT, CONCURRENCY, True))
+    for UID in list(STUB.dashboards)[5:10]:
+        STUB.touch(UID)
+    timed(f"push --concurrency {CONCURRENCY}, 5 changed", STUB, lambda: push(push_args(OUTPUT, CONCURRENCY)))
+    shutil.rmtree(OUTPUT)
@@ -9,6 +9,7 @@ View more information about the CLI by running `python grafana-dashboard.py --he
 import argparse, logging, src.utils as utils
 from src.cli.dashboards.pull import pull as pullCommand
 from src.cli.dashboards.push import push as pushCommand
+from src.grafana.dashboards import MAX_PAGE_SIZE
 
 if __name__ == "__main__":
     # Create the top-level parser
@@ -31,6 +32,39 @@ if __name__ == "__main__":
         default="grafana-dashboards-backup/",
         help="Output directory for the backup",
     )
+    pull.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=8,
+        help="How many dashboards to fetch at once",
+    )
+    pull.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only fetch dashboards whose version changed since the last pull",
+    )
+    pull.add_argument(
+        "--folder",
+        action="append",
+        help="Only pull dashboards in this folder (by folder uid), can be repeated",
+    )
+    pull.add_argument(
+        "--tag",
+        action="append",
+        help="Only pull dashboards with this tag, can be repeated (dashboards must have all of them)",
+    )
+    pull.add_argument(
+        "--uid",
+        action="append",
+        help="Only pull the dashboard with this uid, can be repeated",
+    )
+    pull.add_argument(
+        "--page-size",
+        type=int,
+        default=1000,
+        help="Dashboards per search request (Grafana allows up to 5000)",
+    )
     pull.add_argument(
         "-v",
         "--verbose",
@@ -53,6 +87,18 @@ if __name__ == "__main__":
     push.add_argument(
         "-y", "--yes", action="store_true", help="Skip confirmation prompt"
     )
+    push.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=8,
+        help="How many dashboards to check and import at once",
+    )
+    push.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report which dashboards would be created, updated or left unchanged",
+    )
 
     # Git Related
     pull.add_argument(
@@ -96,6 +142,12 @@ if __name__ == "__main__":
     )
 
     args = grafana.parse_args()
+    if args.subcommand == "pull" and not 1 <= args.page_size <= MAX_PAGE_SIZE:
+        pull.error(f"--page-size must be between 1 and {MAX_PAGE_SIZE}")
+    if args.subcommand == "pull" and args.concurrency < 1:
+        pull.error("--concurrency must be at least 1")
+    if args.subcommand == "push" and args.concurrency < 1:
+        push.error("--concurrency must be at least 1")
 
     # Set logging level
     HANDLERS = []
@@ -1,10 +1,62 @@
 """
 This file contains functions for interacting with the CLI Dashboard Pull command.
 """
-import src.utils as utils, src.git_manager as git_manager, logging
-from src.grafana.dashboards import get_dashboards, get_dashboard, save_dashboard
+import src.utils as utils, src.git_manager as git_manager, logging, os
+from src.grafana.dashboards import (
+    get_dashboards,
+    get_dashboard,
+    get_dashboard_version,
+    dashboard_path,
+    save_dashboard,
+    get_session,
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from src.files import create_folder
+from src.manifest import load_manifest, save_manifest
+
+
+def dashboard_changed(manifest, dir: str, dashboard):
+    """
+    This function checks if a dashboard has to be fetched again, by comparing its version in Grafana with the manifest.\n
+    The version comes from the search result when Grafana includes it, otherwise from the dashboard's version history.
+    Renaming a folder doesn't bump the version, so a dashboard whose path moved is fetched again too.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `manifest` | `dict` | The manifest from `load_manifest` | `None` |
+    | `dir` | `str` | The backup directory | `None` |
+    | `dashboard` | `dict` | The dashboard metadata from `get_dashboards` | `None` |
+    \n
+    Returns the result of the check (`bool`).
+    """
+    ENTRY = manifest.get(dashboard["uid"])
+    if ENTRY is None or not os.path.exists(os.path.join(dir, ENTRY["path"])):
+        return True
+    if dashboard_path(dashboard) != ENTRY["path"]:
+        return True
+    VERSION = dashboard.get("version")
+    if VERSION is None:
+        VERSION = get_dashboard_version(dashboard)
+    return VERSION is None or VERSION != ENTRY["version"]
+
+
+def pull_dashboard(args, manifest, dashboard):
+    """
+    This function backs up one dashboard: it fetches it, serializes it and writes it if it changed.\n
+    With `--incremental`, dashboards whose version didn't change are skipped without fetching them.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `args` | `argparse.Namespace` | The arguments passed to the CLI command | `None` |
+    | `manifest` | `dict` | The manifest from `load_manifest` | `None` |
+    | `dashboard` | `dict` | The dashboard metadata from `get_dashboards` | `None` |
+    \n
+    Returns the path of the written file, or `None` if nothing was written.
+    """
+    if args.incremental and not dashboard_changed(manifest, args.output, dashboard):
+        return None
+    return save_dashboard(args.output, dashboard, get_dashboard(dashboard), manifest)
 
 
 def pull(args):
@@ -16,31 +68,51 @@ def pull(args):
     | `args` | `argparse.Namespace` | The arguments passed to the CLI command | `None` |
     """
 
-    # Get all the dashboards in Grafana
-    DASHBOARDS_METADATA = get_dashboards()
-    DASHBOARD_PATH = []
-    DASHBOARDS = []
-    for DASHBOARD in DASHBOARDS_METADATA:
-        DASHBOARDS.append(get_dashboard(DASHBOARD))
+    # One pooled connection per worker, plus one for paging through the search
+    get_session(args.concurrency + 1)
 
     # Create the output folder
     create_folder(args.output)
+    MANIFEST = load_manifest(args.output)
 
-    # Save all the dashboards
-    for DASHBOARD in DASHBOARDS_METADATA:
-        DASHBOARD_PATH.append(
-            save_dashboard(
-                args.output, DASHBOARD, DASHBOARDS[DASHBOARDS_METADATA.index(DASHBOARD)]
-            )
-        )
+    # Back up every dashboard in Grafana, fetching and writing each one on a worker.
+    # At most two per worker are in flight, so only that many dashboards are ever held in memory.
+    LISTED = set()
+    DASHBOARD_PATH = []
+
+    def list_dashboards():
+        for DASHBOARD in get_dashboards(args.folder, args.tag, args.uid, args.page_size):
+            LISTED.add(DASHBOARD["uid"])
+            yield DASHBOARD
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as EXECUTOR:
+        for PATH in utils.bounded_map(
+            EXECUTOR,
+            lambda DASHBOARD: pull_dashboard(args, MANIFEST, DASHBOARD),
+            list_dashboards(),
+            args.concurrency * 2,
+        ):
+            if PATH is not None:
+                DASHBOARD_PATH.append(PATH)
+
+    # Forget dashboards that were deleted from Grafana, their files stay.
+    # A filtered pull only saw some of them, so it can't tell.
+    if not (args.folder or args.tag or args.uid):
+        for UID in set(MANIFEST) - LISTED:
+            del MANIFEST[UID]
+    MANIFEST_PATH = save_manifest(args.output, MANIFEST)
+    logging.info(f"{len(DASHBOARD_PATH)} Dashboard Files Written!")
 
     # Git
     if args.git_commit:
         # Get the git repo
         REPO = git_manager.get_git_repo(args.output, args.branch)
 
-        # Commit and push
-        git_manager.git_commit(REPO, DASHBOARD_PATH)
+        # Commit only the files that changed, if any
+        if DASHBOARD_PATH:
+            git_manager.git_commit(REPO, DASHBOARD_PATH + [MANIFEST_PATH])
+        else:
+            logging.info("No Dashboards Changed, Skipping Git Commit...")
 
         # If the user passed the --git-push flag
         if args.git_push:
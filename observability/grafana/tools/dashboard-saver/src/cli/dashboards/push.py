@@ -2,10 +2,60 @@
 This file contains functions for interacting with the CLI Dashboard Push command.
 """
 
-import sys, difflib, json, datetime
-from src.files import walk_dir_with_dashboard
-from src.grafana.dashboards import dashboard_exists, get_dashboard, import_dashboard
-from src.utils import send_webhook
+import sys, difflib, json, logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from src.files import read_dashboards
+from src.grafana.dashboards import get_dashboards, get_dashboard, import_dashboard, get_session
+from src.manifest import load_manifest, content_hash
+from src.cli.dashboards.pull import dashboard_changed
+from src.utils import send_webhook, bounded_map
+
+
+def plan_dashboard(args, listed, manifest, local):
+    """
+    This function decides what pushing one dashboard file does: `create`, `update` or `unchanged`.\n
+    Whether the dashboard exists comes from the search listing. An existing one is only fetched
+    to compare with the file when the manifest can't tell that neither side changed since the last pull.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `args` | `argparse.Namespace` | The arguments passed to the CLI command | `None` |
+    | `listed` | `dict` | The dashboards in Grafana from `get_dashboards`, by `uid` | `None` |
+    | `manifest` | `dict` | The manifest of the input directory from `load_manifest` | `None` |
+    | `local` | `tuple` | The `(path, content, dashboard)` of the file from `read_dashboards` | `None` |
+    \n
+    Returns a `(action, path, dashboard, diff)` tuple. `diff` is only set for updates that have to be confirmed.
+    """
+    PATH, CONTENT, DASHBOARD = local
+    UID = DASHBOARD["dashboard"]["uid"]
+    if UID not in listed:
+        return "create", PATH, DASHBOARD, None
+
+    ENTRY = manifest.get(UID)
+    if (
+        ENTRY is not None
+        and ENTRY.get("hash") == content_hash(CONTENT)
+        and not dashboard_changed(manifest, args.input, listed[UID])
+    ):
+        return "unchanged", PATH, None, None
+
+    GRAFANA_CONTENT = json.dumps(get_dashboard(listed[UID]), indent=2)
+    if GRAFANA_CONTENT == CONTENT:
+        return "unchanged", PATH, None, None
+    if args.yes or args.dry_run:
+        return "update", PATH, DASHBOARD, None
+
+    GRAFANA_FILE = f'{DASHBOARD["dashboard"]["title"]}.json'
+    DIFF = list(
+        difflib.unified_diff(
+            GRAFANA_CONTENT.splitlines(),
+            CONTENT.splitlines(),
+            fromfile=GRAFANA_FILE,
+            tofile=GRAFANA_FILE,
+        )
+    )
+    return "update", PATH, DASHBOARD, DIFF
 
 
 def push(args):
@@ -17,46 +67,60 @@ def push(args):
     | `args` | `argparse.Namespace` | The arguments passed to the CLI command | `None` |
     """
 
-    # Get all the dashboards in the input directory
-    DASHBOARDS = list(walk_dir_with_dashboard(args.input))
-
-    # Push all the dashboards
-    for index, dashboard in enumerate(DASHBOARDS):
-        # Open and read the dashboard file
-        dashboard = open(dashboard).read()
-
-        # Check if the dashboard exists
-        if dashboard_exists(dashboard):
-            # If it exists
-            # Get the dashboard from Grafana
-            GRAFANA_FILE = f'{json.loads(dashboard)["dashboard"]["title"]}.json'
-            GRAFANA_DASHBOARD = json.dumps(
-                get_dashboard(json.loads(dashboard)["dashboard"]), indent=2
-            )
-
-            # Print the diff number
-            print(f"Showing Dashboard Diff ({index + 1}/{len(DASHBOARDS)})")
-            # If the dashboard is different and the user didn't pass the --yes flag
-            if GRAFANA_DASHBOARD != dashboard and not args.yes:
-                # Print the diff
-                for l in difflib.unified_diff(
-                    GRAFANA_DASHBOARD.splitlines(),
-                    dashboard.splitlines(),
-                    fromfile=GRAFANA_FILE,
-                    tofile=GRAFANA_FILE,
-                ):
-                    print(l)
-
-                # Ask the user if they want to continue
-                if input("Continue? [y/N] ").lower() != "y":
-                    # If they don't want to continue, exit
-                    sys.exit(1)
-
-            # Import the dashboard to Grafana
-            import_dashboard(json.loads(dashboard), new=False)
-        else:
-            # If it doesn't exist, import it
-            import_dashboard(json.loads(dashboard))
+    # One pooled connection per worker, plus one for paging through the search
+    get_session(args.concurrency + 1)
+
+    # Find out which dashboards exist from one (paged) search, instead of asking for each one
+    LISTED = {DASHBOARD["uid"]: DASHBOARD for DASHBOARD in get_dashboards()}
+    MANIFEST = load_manifest(args.input)
+
+    # Read every dashboard file once and work out what to do with it, on the workers
+    PLAN = []
+    COUNTS = {"create": 0, "update": 0, "unchanged": 0}
+    with ThreadPoolExecutor(max_workers=args.concurrency) as EXECUTOR:
+        for ACTION, PATH, DASHBOARD, DIFF in bounded_map(
+            EXECUTOR,
+            lambda LOCAL: plan_dashboard(args, LISTED, MANIFEST, LOCAL),
+            read_dashboards(args.input),
+            args.concurrency * 2,
+        ):
+            COUNTS[ACTION] += 1
+            if ACTION != "unchanged":
+                PLAN.append((ACTION, PATH, DASHBOARD, DIFF))
+
+    if args.dry_run:
+        for ACTION, PATH, _, _ in PLAN:
+            print(f"Would {ACTION.capitalize()}: {PATH}")
+        print(
+            f"Dry Run: {COUNTS['create']} To Create, {COUNTS['update']} To Update, {COUNTS['unchanged']} Unchanged"
+        )
+        return
+
+    # Show the diff of every update and ask before anything is imported
+    UPDATES = [ENTRY for ENTRY in PLAN if ENTRY[3] is not None]
+    for index, (_, _, _, DIFF) in enumerate(UPDATES):
+        # Print the diff number and the diff
+        print(f"Showing Dashboard Diff ({index + 1}/{len(UPDATES)})")
+        for l in DIFF:
+            print(l)
+
+        # Ask the user if they want to continue
+        if input("Continue? [y/N] ").lower() != "y":
+            # If they don't want to continue, exit
+            sys.exit(1)
+
+    # Import the new and changed dashboards, a few at a time
+    with ThreadPoolExecutor(max_workers=args.concurrency) as EXECUTOR:
+        for _ in bounded_map(
+            EXECUTOR,
+            lambda ENTRY: import_dashboard(ENTRY[2], new=ENTRY[0] == "create"),
+            PLAN,
+            args.concurrency * 2,
+        ):
+            pass
+    logging.info(
+        f"{COUNTS['create']} Dashboards Created, {COUNTS['update']} Updated, {COUNTS['unchanged']} Unchanged!"
+    )
 
     # Send the webhook if the user passed the --webhook & --webhook-url flag
     if args.webhook:
@@ -3,8 +3,7 @@ This file contains functions for working with files.
 i.e. creating folders, walking directories, etc.
 """
 
-import logging, os
-from src.grafana.dashboards import is_dashboard
+import json, logging, os
 
 
 def create_folder(NAME: str):
@@ -27,20 +26,28 @@ def create_folder(NAME: str):
         logging.info(f"Folder, {NAME}, Exists, Skipping...")
 
 
-def walk_dir_with_dashboard(dir: str):
+def read_dashboards(dir: str):
     """
-    This function walks a directory and yields the path of the files that are dashboards.\n
-    It uses the `is_dashboard` function from `src.grafana.dashboards` to check if the file is a dashboard.\n
+    This function walks a directory and yields every dashboard file in it, read and parsed once.\n
+    Files that aren't JSON, or aren't Grafana dashboards (`meta.type` isn't `db`), are skipped.
     \n
     | Argument | Type | Description | Default |
     | -------- | ---- | ----------- | ------- |
     | `dir` | `str` | The directory to walk. | `None` |
     \n
-    Returns a `generator` with the paths of the files that are dashboards.
+    Returns a `generator` of `(path, content, dashboard)`, with the file content (`str`) and the parsed dashboard (`dict`).
     """
     for root, _, files in os.walk(dir):
-        for file in files:
-            if file.endswith(f".json") and is_dashboard(
-                open(os.path.join(root, file)).read()
-            ):
-                yield os.path.join(root, file)
+        for file in sorted(files):
+            if not file.endswith(".json"):
+                continue
+            PATH = os.path.join(root, file)
+            with open(PATH) as f:
+                CONTENT = f.read()
+            try:
+                DASHBOARD = json.loads(CONTENT)
+            except ValueError:
+                logging.info(f"Not JSON, Skipping: {PATH}")
+                continue
+            if isinstance(DASHBOARD, dict) and DASHBOARD.get("meta", {}).get("type") == "db":
+                yield PATH, CONTENT, DASHBOARD
@@ -1,9 +1,41 @@
 """
 This file contains functions for interacting with Grafana Dashboard API.  
-It contains functions for getting, saving, importing, and checking if a dashboard exists in Grafana.  
+It contains functions for listing, getting, saving and importing dashboards in Grafana.  
 """
-import logging, requests, json, os
+import logging, requests, json, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from src.utils import get_env, create_headers, filter_invalid_chars
+from src.manifest import content_hash
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+# The most results Grafana returns for one search
+MAX_PAGE_SIZE = 5000
+
+
+def get_session(POOL_SIZE: int = 10):
+    """
+    This function returns the `requests.Session` shared by all Grafana API calls.\n
+    It is created on first use with the Grafana auth headers and a keep-alive connection pool,
+    so each call reuses an open connection instead of doing a new TCP+TLS handshake.\n
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `POOL_SIZE` | `int` | How many connections to keep open, at least the number of concurrent workers. Only used when the session is created. | `10` |
+    \n
+    Returns a `requests.Session`.
+    """
+    global SESSION
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            SESSION.headers.update(create_headers(grafana_auth=True))
+            ADAPTER = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            SESSION.mount("http://", ADAPTER)
+            SESSION.mount("https://", ADAPTER)
+    return SESSION
 
 
 def create_dash_folder(NAME: str):
@@ -20,27 +52,73 @@ def create_dash_folder(NAME: str):
     """
     logging.info(f"Creating Folder: {NAME}...")
     if not os.path.exists(NAME):
-        os.makedirs(NAME)
+        # Another worker may create it at the same time
+        os.makedirs(NAME, exist_ok=True)
         logging.info(f"Folder Created: {NAME}!")
     else:
         logging.info(f"Folder, {NAME}, Exists, Skipping...")
 
 
-def get_dashboards():
+def get_dashboards_page(page: int, page_size: int, folders=None, tags=None, uids=None):
     """
-    This function gets all the dashboards from the Grafana API.
+    This function gets one page of dashboards from the Grafana search API.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `page` | `int` | The page to get, starting at `1` | `None` |
+    | `page_size` | `int` | How many dashboards per page, Grafana allows up to `5000` | `None` |
+    | `folders` | `list<str>` | Only dashboards in these folders (by folder `uid`) | `None` |
+    | `tags` | `list<str>` | Only dashboards that have all of these tags | `None` |
+    | `uids` | `list<str>` | Only the dashboards with these `uid`s | `None` |
     \n
     Returns a `list<dict>` of dashboards.
     """
-    logging.info("Querying Grafana API for Dashboards...")
+    PARAMS = [("query", ""), ("type", "dash-db"), ("limit", page_size), ("page", page)]
+    PARAMS += [("folderUIDs", FOLDER) for FOLDER in folders or []]
+    PARAMS += [("tag", TAG) for TAG in tags or []]
+    PARAMS += [("dashboardUIDs", UID) for UID in uids or []]
 
-    dashboards = requests.get(
-        f"{get_env('GRAFANA_URL')}/api/search?query=&type=dash-db",
-        headers=create_headers(grafana_auth=True),
-    ).json()
+    logging.info(f"Querying Grafana API for Dashboards, Page {page}...")
+    RESPONSE = get_session().get(f"{get_env('GRAFANA_URL')}/api/search", params=PARAMS)
+    RESPONSE.raise_for_status()
+    return RESPONSE.json()
+
+
+def get_dashboards(folders=None, tags=None, uids=None, page_size: int = 1000):
+    """
+    This function gets all the dashboards from the Grafana API, page by page.\n
+    Grafana caps each search (1000 results by default), so this keeps asking for the next page until one comes back short.
+    The next page is already being fetched while the current one is used.
+    `page_size` is kept between `1` and `MAX_PAGE_SIZE`, as a bigger page would come back short and end the listing early.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `folders` | `list<str>` | Only dashboards in these folders (by folder `uid`) | `None` |
+    | `tags` | `list<str>` | Only dashboards that have all of these tags | `None` |
+    | `uids` | `list<str>` | Only the dashboards with these `uid`s | `None` |
+    | `page_size` | `int` | How many dashboards to ask for per page | `1000` |
+    \n
+    Returns a `generator` of dashboards (`dict`).
+    """
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    SEEN = set()
+    with ThreadPoolExecutor(max_workers=1) as PAGER:
+        PAGE = 1
+        NEXT = PAGER.submit(get_dashboards_page, PAGE, page_size, folders, tags, uids)
+        while True:
+            DASHBOARDS = NEXT.result()
+            if len(DASHBOARDS) >= page_size:
+                NEXT = PAGER.submit(get_dashboards_page, PAGE + 1, page_size, folders, tags, uids)
+            for DASHBOARD in DASHBOARDS:
+                # A dashboard created while paging can shift another onto the next page too
+                if DASHBOARD["uid"] not in SEEN:
+                    SEEN.add(DASHBOARD["uid"])
+                    yield DASHBOARD
+            if len(DASHBOARDS) < page_size:
+                break
+            PAGE += 1
 
-    logging.info(f"Dashboards Queried, {len(dashboards)} Dashboards Found!")
-    return dashboards
+    logging.info(f"Dashboards Queried, {len(SEEN)} Dashboards Found!")
 
 
 def get_dashboard(dashboard):
@@ -56,26 +134,51 @@ def get_dashboard(dashboard):
 
     logging.info(f"Querying Grafana API for Dashboard: {dashboard['title']}...")
 
-    dashboard = requests.get(
-        f"{get_env('GRAFANA_URL')}/api/dashboards/uid/{dashboard['uid']}",
-        headers=create_headers(grafana_auth=True),
+    dashboard = get_session().get(
+        f"{get_env('GRAFANA_URL')}/api/dashboards/uid/{dashboard['uid']}"
     ).json()
 
     logging.info(f"Dashboard Queried, {dashboard['dashboard']['title']} Found!")
     return dashboard
 
 
-def save_dashboard(dir: str, dashboard_meta, dashboard):
+def get_dashboard_version(dashboard):
     """
-    This function saves a dashboard to the specified directory.
+    This function gets the current version of a dashboard from the Grafana API, without fetching the dashboard itself.\n
+    It asks for the latest entry of the dashboard's version history, by `uid` and on older Grafana versions by `id`.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `dashboard` | `dict` | The dashboard metadata from `get_dashboards`. It must have a `uid` and an `id` key | `None` |
+    \n
+    Returns the version (`int`), or `None` if Grafana didn't say.
+    """
+    RESPONSE = get_session().get(
+        f"{get_env('GRAFANA_URL')}/api/dashboards/uid/{dashboard['uid']}/versions?limit=1"
+    )
+    if RESPONSE.status_code == 404:
+        RESPONSE = get_session().get(
+            f"{get_env('GRAFANA_URL')}/api/dashboards/id/{dashboard['id']}/versions?limit=1"
+        )
+    if not RESPONSE.ok:
+        return None
+
+    # A list before Grafana 11, an object with a `versions` list since
+    VERSIONS = RESPONSE.json()
+    if isinstance(VERSIONS, dict):
+        VERSIONS = VERSIONS.get("versions", [])
+    return VERSIONS[0]["version"] if VERSIONS else None
+
+
+def dashboard_path(dashboard_meta):
+    """
+    This function returns where a dashboard is saved, relative to the backup directory.
     \n
     | Argument | Type | Description | Default |
     | -------- | ---- | ----------- | ------- |
-    | `dir` | `str` | The directory to save the dashboard to | `None` |
     | `dashboard_meta` | `dict` | The dashboard metadata. It must have a `title` and a `folderTitle` key. | `None` |
-    | `dashboard` | `dict` | The dashboard returned from `get_dashboard` | `None` |
     \n
-    Returns the path to the saved dashboard.
+    Returns a `str` like `Folder/Title.json`.
     """
     DASH_TITLE = filter_invalid_chars(dashboard_meta["title"])
     DASH_FOLDER = (
@@ -83,15 +186,53 @@ def save_dashboard(dir: str, dashboard_meta, dashboard):
         if "folderTitle" in dashboard_meta
         else "General"
     )
-    FOLDER = f"{ dir[:-1] if dir.endswith('/') else dir}/{DASH_FOLDER}"
+    return f"{DASH_FOLDER}/{DASH_TITLE}.json"
 
-    create_dash_folder(FOLDER)
-    with open(f"{FOLDER}/{DASH_TITLE}.json", "w") as f:
-        logging.info(f"Saving Dashboard: {DASH_FOLDER}/{DASH_TITLE}...")
-        json.dump(dashboard, f, indent=2)
-        logging.info(f"Dashboard Saved: {DASH_FOLDER}/{DASH_TITLE}!")
 
-    return f"{DASH_FOLDER}/{DASH_TITLE}.json"
+def save_dashboard(dir: str, dashboard_meta, dashboard, manifest=None):
+    """
+    This function saves a dashboard to the specified directory.\n
+    With a `manifest`, the file is only written when its content changed, and the manifest entry is updated.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `dir` | `str` | The directory to save the dashboard to | `None` |
+    | `dashboard_meta` | `dict` | The dashboard metadata. It must have a `title` and a `folderTitle` key. | `None` |
+    | `dashboard` | `dict` | The dashboard returned from `get_dashboard` | `None` |
+    | `manifest` | `dict` | The manifest from `load_manifest` | `None` |
+    \n
+    Returns the path to the saved dashboard, or `None` if it was unchanged.
+    """
+    PATH = dashboard_path(dashboard_meta)
+    FILE = f"{ dir[:-1] if dir.endswith('/') else dir}/{PATH}"
+    CONTENT = json.dumps(dashboard, indent=2)
+    HASH = content_hash(CONTENT)
+
+    if manifest is not None:
+        ENTRY = manifest.get(dashboard_meta["uid"], {})
+        manifest[dashboard_meta["uid"]] = {
+            "version": dashboard["meta"].get("version"),
+            "updated": dashboard["meta"].get("updated"),
+            "hash": HASH,
+            "path": PATH,
+        }
+        if os.path.exists(FILE):
+            OLD_HASH = ENTRY.get("hash") if ENTRY.get("path") == PATH else None
+            if OLD_HASH is None:
+                # Not in the manifest yet (e.g. an older backup), compare with the file itself
+                with open(FILE) as f:
+                    OLD_HASH = content_hash(f.read())
+            if OLD_HASH == HASH:
+                logging.info(f"Dashboard Unchanged, Skipping: {PATH}")
+                return None
+
+    create_dash_folder(os.path.dirname(FILE))
+    with open(FILE, "w") as f:
+        logging.info(f"Saving Dashboard: {PATH}...")
+        f.write(CONTENT)
+        logging.info(f"Dashboard Saved: {PATH}!")
+
+    return PATH
 
 
 def import_dashboard(dashboard, new=True):
@@ -120,47 +261,6 @@ def import_dashboard(dashboard, new=True):
         body["dashboard"]["id"] = None
         body["dashboard"]["version"] = None
 
-    requests.post(
-        f"{get_env('GRAFANA_URL')}/api/dashboards/import",
-        headers=create_headers(grafana_auth=True),
-        json=body,
-    )
+    get_session().post(f"{get_env('GRAFANA_URL')}/api/dashboards/import", json=body)
 
     logging.info(f"Dashboard Imported: {dashboard['dashboard']['title']}!")
-
-
-def is_dashboard(dashboard):
-    """
-    This function checks if the dashboard is a Grafana dashboard, via the `meta.type` key.
-    \n
-    | Argument | Type | Description | Default |
-    | -------- | ---- | ----------- | ------- |
-    | `dashboard` | `dict` | The dashboard to check | `None` |
-    \n
-    Returns the result of the check (`bool`).
-    """
-    return json.loads(dashboard)["meta"]["type"] == "db"
-
-
-def dashboard_exists(dashboard):
-    """
-    This function checks if the dashboard exists in Grafana.
-    \n
-    | Argument | Type | Description | Default |
-    | -------- | ---- | ----------- | ------- |
-    | `dashboard` | `dict` | The dashboard to check. It must have a `dashboard.title` and a `dashboard.uid` key. | `None` |
-    \n
-    Returns the result of the check (`bool`).
-    """
-    dashboard = json.loads(dashboard)
-    logging.info(
-        f"Testing if Grafana Dashboard, {dashboard['dashboard']['title']}, exists..."
-    )
-
-    status = requests.get(
-        f"{get_env('GRAFANA_URL')}/api/dashboards/uid/{dashboard['dashboard']['uid']}",
-        headers=create_headers(grafana_auth=True),
-    ).status_code
-
-    logging.info(f"Grafana Dashboard Exist Test Completed")
-    return status != 404
@@ -0,0 +1,64 @@
+"""
+This file contains functions for the backup manifest.
+The manifest keeps the version, update time, content hash and path of every saved dashboard,
+so `pull --incremental` can skip dashboards that didn't change.
+"""
+
+import hashlib, json, logging, os
+
+MANIFEST_FILE = ".dashboard-manifest.json"
+
+
+def load_manifest(dir: str):
+    """
+    This function loads the manifest from the backup directory.\n
+    If there is no manifest yet (or it can't be read), it returns an empty one.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `dir` | `str` | The backup directory | `None` |
+    \n
+    Returns a `dict` of `uid` -> `{version, updated, hash, path}`.
+    """
+    PATH = os.path.join(dir, MANIFEST_FILE)
+    try:
+        with open(PATH) as f:
+            MANIFEST = json.load(f)
+        logging.info(f"Manifest Loaded, {len(MANIFEST)} Dashboards Known!")
+        return MANIFEST
+    except (OSError, ValueError):
+        logging.info("No Manifest Found, Starting a New One...")
+        return {}
+
+
+def save_manifest(dir: str, manifest):
+    """
+    This function saves the manifest to the backup directory.\n
+    It writes a temporary file first, so an interrupted run never leaves a broken manifest.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `dir` | `str` | The backup directory | `None` |
+    | `manifest` | `dict` | The manifest to save | `None` |
+    \n
+    Returns the path of the manifest, relative to `dir`.
+    """
+    PATH = os.path.join(dir, MANIFEST_FILE)
+    with open(PATH + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(PATH + ".tmp", PATH)
+    logging.info("Manifest Saved!")
+    return MANIFEST_FILE
+
+
+def content_hash(content: str):
+    """
+    This function hashes the content of a dashboard file.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `content` | `str` | The serialized dashboard | `None` |
+    \n
+    Returns a `str` with the hex SHA-256 of the content.
+    """
+    return hashlib.sha256(content.encode()).hexdigest()
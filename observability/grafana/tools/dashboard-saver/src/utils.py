@@ -3,6 +3,7 @@ This file contains utility functions used throughout the project.
 i.e. environment variable checks, webhook sending, etc.
 """
 import os, logging, requests
+from collections import deque
 
 
 def has_required_env():
@@ -72,6 +73,30 @@ def get_env(key: str):
     return os.environ[key]
 
 
+def bounded_map(executor, function, iterable, window: int):
+    """
+    This function works like `executor.map`, but keeps at most `window` calls in flight.\n
+    Items are only taken from `iterable` as earlier calls finish, so a long (or lazily paged) iterable
+    is never read ahead and finished results don't pile up in memory.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `executor` | `concurrent.futures.Executor` | The executor to run the calls on | `None` |
+    | `function` | `callable` | The function to call with each item | `None` |
+    | `iterable` | `iterable` | The items | `None` |
+    | `window` | `int` | How many calls may be queued or running at once | `None` |
+    \n
+    Returns a `generator` with the results, in the order of `iterable`.
+    """
+    PENDING = deque()
+    for ITEM in iterable:
+        PENDING.append(executor.submit(function, ITEM))
+        if len(PENDING) >= window:
+            yield PENDING.popleft().result()
+    while PENDING:
+        yield PENDING.popleft().result()
+
+
 def send_webhook(url: str, data: str):
     """
     This function sends a webhook to the specified URL with the specified data.\n
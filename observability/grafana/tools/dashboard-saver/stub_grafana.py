@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+"""
+This file contains a stub of the Grafana HTTP API, for benchmarking and trying out the CLI without a real Grafana.
+It serves synthetic dashboards on `/api/search`, `/api/dashboards/uid/<uid>`, `/api/dashboards/uid/<uid>/versions`
+and `/api/dashboards/import`,
+and can add a delay to every new connection (like a TLS handshake) and to every request (like network latency).
+Run it with `python stub_grafana.py --dashboards 300`, then point `GRAFANA_URL` at it (any `GRAFANA_APIKEY` works).
+`pull_args` and `push_args` build the arguments the CLI commands get, for the benchmark and the tests.
+"""
+
+import argparse, json, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class StubGrafana:
+    """
+    This class holds the stub's dashboards and answers the API calls.\n
+    Only the metadata of each dashboard is stored, the panels are generated on every request,
+    so thousands of dashboards take little memory.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `COUNT` | `int` | How many dashboards to create. | `None` |
+    | `PANELS` | `int` | How many panels each dashboard has. | `10` |
+    | `FOLDERS` | `int` | How many folders the dashboards are spread over. | `10` |
+    | `SEARCH_LIMIT` | `int` | How many search hits to return when the request doesn't set `limit`. | `1000` |
+    """
+
+    def __init__(self, COUNT: int, PANELS: int = 10, FOLDERS: int = 10, SEARCH_LIMIT: int = 1000):
+        self.panels = PANELS
+        self.search_limit = SEARCH_LIMIT
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.dashboards = {}
+        for INDEX in range(COUNT):
+            UID = f"stub-{INDEX:06d}"
+            self.dashboards[UID] = {
+                "id": INDEX + 1,
+                "uid": UID,
+                "title": f"Dashboard {INDEX}",
+                "tags": [f"team-{INDEX % 7}"],
+                "folderUid": f"folder-{INDEX % FOLDERS}",
+                "folderTitle": f"Folder {INDEX % FOLDERS}",
+                "version": 1,
+                "updated": "2023-01-01T00:00:00Z",
+            }
+
+    def count(self, ROUTE: str):
+        with self.lock:
+            self.requests[ROUTE] = self.requests.get(ROUTE, 0) + 1
+
+    def search(self, QUERY):
+        FOLDERS = set(QUERY.get("folderUIDs", []))
+        TAGS = set(QUERY.get("tag", []))
+        UIDS = set(QUERY.get("dashboardUIDs", []))
+        HITS = [
+            {
+                "id": DASH["id"],
+                "uid": DASH["uid"],
+                "title": DASH["title"],
+                "uri": f"db/{DASH['uid']}",
+                "url": f"/d/{DASH['uid']}",
+                "type": "dash-db",
+                "tags": DASH["tags"],
+                "isStarred": False,
+                "folderUid": DASH["folderUid"],
+                "folderTitle": DASH["folderTitle"],
+            }
+            for DASH in self.dashboards.values()
+            if (not FOLDERS or DASH["folderUid"] in FOLDERS)
+            and TAGS <= set(DASH["tags"])
+            and (not UIDS or DASH["uid"] in UIDS)
+        ]
+        # Grafana returns at most 1000 hits unless asked for more, and never more than 5000
+        LIMIT = min(int(QUERY.get("limit", [self.search_limit])[0]), 5000)
+        PAGE = int(QUERY.get("page", ["1"])[0])
+        return HITS[(PAGE - 1) * LIMIT : PAGE * LIMIT]
+
+    def dashboard(self, UID: str):
+        DASH = self.dashboards.get(UID)
+        if DASH is None:
+            return None
+        return {
+            "meta": {
+                "type": "db",
+                "slug": DASH["uid"],
+                "url": f"/d/{DASH['uid']}",
+                "folderUid": DASH["folderUid"],
+                "folderTitle": DASH["folderTitle"],
+                "version": DASH["version"],
+                "updated": DASH["updated"],
+            },
+            "dashboard": {
+                "id": DASH["id"],
+                "uid": DASH["uid"],
+                "title": DASH["title"],
+                "tags": DASH["tags"],
+                "version": DASH["version"],
+                "schemaVersion": 37,
+                "panels": [
+                    {
+                        "id": PANEL,
+                        "type": "timeseries",
+                        "title": f"Panel {PANEL}",
+                        "gridPos": {"h": 8, "w": 12, "x": PANEL % 2 * 12, "y": PANEL // 2 * 8},
+                        "targets": [
+                            {"refId": "A", "target": f"stats.{DASH['uid']}.panel{PANEL}.*"}
+                        ],
+                    }
+                    for PANEL in range(self.panels)
+                ],
+            },
+        }
+
+    def versions(self, UID: str):
+        DASH = self.dashboards.get(UID)
+        if DASH is None:
+            return None
+        # The pre Grafana 11 shape, only the newest entry like `?limit=1`
+        return [{"version": DASH["version"], "created": DASH["updated"]}]
+
+    def touch(self, UID: str):
+        # Like someone saving the dashboard in the UI
+        with self.lock:
+            self.dashboards[UID]["version"] += 1
+            self.dashboards[UID]["updated"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def import_dashboard(self, BODY):
+        NEW = BODY["dashboard"]
+        with self.lock:
+            DASH = self.dashboards.get(NEW["uid"])
+            if DASH is None:
+                DASH = self.dashboards[NEW["uid"]] = {
+                    "id": len(self.dashboards) + 1,
+                    "uid": NEW["uid"],
+                    "version": 0,
+                    "folderTitle": "General",
+                }
+            DASH.update(
+                title=NEW["title"],
+                tags=NEW.get("tags", []),
+                folderUid=BODY.get("folderUid", ""),
+                version=DASH["version"] + 1,
+                updated=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            )
+        return {"uid": DASH["uid"], "version": DASH["version"], "status": "success"}
+
+
+def make_handler(STUB: StubGrafana, LATENCY: float, CONNECT_DELAY: float):
+    """
+    This function creates the request handler class serving `STUB`.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `STUB` | `StubGrafana` | The dashboards to serve. | `None` |
+    | `LATENCY` | `float` | Seconds to wait before answering each request. | `None` |
+    | `CONNECT_DELAY` | `float` | Seconds to wait on each new connection. | `None` |
+    \n
+    Returns a `BaseHTTPRequestHandler` subclass.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive, like Grafana behind its usual proxies
+        protocol_version = "HTTP/1.1"
+        # Send headers and body in one packet, or delayed ACKs add 40ms to every request
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            STUB.count("connect")
+            time.sleep(CONNECT_DELAY)
+            super().setup()
+
+        def reply(self, STATUS, BODY):
+            DATA = json.dumps(BODY).encode()
+            time.sleep(LATENCY)
+            self.send_response(STATUS)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(DATA)))
+            self.end_headers()
+            self.wfile.write(DATA)
+
+        def do_GET(self):
+            URL = urlsplit(self.path)
+            QUERY = parse_qs(URL.query)
+            if URL.path == "/api/search":
+                STUB.count("search")
+                return self.reply(200, STUB.search(QUERY))
+            if URL.path.startswith("/api/dashboards/uid/") and URL.path.endswith("/versions"):
+                STUB.count("versions")
+                VERSIONS = STUB.versions(URL.path.split("/")[4])
+                if VERSIONS is None:
+                    return self.reply(404, {"message": "Dashboard not found"})
+                return self.reply(200, VERSIONS)
+            if URL.path.startswith("/api/dashboards/uid/"):
+                STUB.count("dashboard")
+                DASH = STUB.dashboard(URL.path.split("/")[4])
+                if DASH is None:
+                    return self.reply(404, {"message": "Dashboard not found"})
+                return self.reply(200, DASH)
+            self.reply(404, {"message": "Not found"})
+
+        def do_POST(self):
+            BODY = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if urlsplit(self.path).path == "/api/dashboards/import":
+                STUB.count("import")
+                return self.reply(200, STUB.import_dashboard(BODY))
+            self.reply(404, {"message": "Not found"})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(STUB: StubGrafana, PORT: int = 0, LATENCY: float = 0.0, CONNECT_DELAY: float = 0.0):
+    """
+    This function starts serving `STUB` on a background thread.
+    \n
+    | Argument | Type | Description | Default |
+    | -------- | ---- | ----------- | ------- |
+    | `STUB` | `StubGrafana` | The dashboards to serve. | `None` |
+    | `PORT` | `int` | The port to listen on, `0` picks a free one. | `0` |
+    | `LATENCY` | `float` | Seconds to wait before answering each request. | `0.0` |
+    | `CONNECT_DELAY` | `float` | Seconds to wait on each new connection. | `0.0` |
+    \n
+    Returns the running `ThreadingHTTPServer`, its URL is `http://127.0.0.1:<server.server_port>`.
+    """
+    SERVER = ThreadingHTTPServer(("127.0.0.1", PORT), make_handler(STUB, LATENCY, CONNECT_DELAY))
+    SERVER.daemon_threads = True
+    threading.Thread(target=SERVER.serve_forever, daemon=True).start()
+    return SERVER
+
+
+def pull_args(OUTPUT: str, CONCURRENCY: int, INCREMENTAL: bool = False):
+    """
+    This function creates the arguments `pull` gets from the CLI, with git and webhooks off.
+    """
+    return argparse.Namespace(
+        output=OUTPUT,
+        concurrency=CONCURRENCY,
+        incremental=INCREMENTAL,
+        folder=None,
+        tag=None,
+        uid=None,
+        page_size=1000,
+        git_commit=False,
+        git_push=False,
+        webhook=False,
+    )
+
+
+def push_args(INPUT: str, CONCURRENCY: int, DRY_RUN: bool = False):
+    """
+    This function creates the arguments `push` gets from the CLI, without prompts and webhooks.
+    """
+    return argparse.Namespace(
+        input=INPUT,
+        concurrency=CONCURRENCY,
+        dry_run=DRY_RUN,
+        yes=True,
+        webhook=False,
+    )
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(description="Stub Grafana API serving synthetic dashboards")
+    PARSER.add_argument("--dashboards", type=int, default=300)
+    PARSER.add_argument("--panels", type=int, default=10)
+    PARSER.add_argument("--search-limit", type=int, default=1000, help="Search hits returned without a limit parameter")
+    PARSER.add_argument("--port", type=int, default=3300)
+    PARSER.add_argument("--latency", type=float, default=0.0)
+    PARSER.add_argument("--connect-delay", type=float, default=0.0)
+    ARGS = PARSER.parse_args()
+
+    STUB = StubGrafana(ARGS.dashboards, ARGS.panels, SEARCH_LIMIT=ARGS.search_limit)
+    SERVER = serve(STUB, ARGS.port, ARGS.latency, ARGS.connect_delay)
+    print(f"Stub Grafana on http://127.0.0.1:{SERVER.server_port}")
+    threading.Event().wait()
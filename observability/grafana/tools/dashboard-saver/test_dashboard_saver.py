@@ -0,0 +1,133 @@
+# pull and push against the stub Grafana: python -m pytest test_dashboard_saver.py
+import json, os, pytest
+import src.grafana.dashboards as dashboards
+from src.cli.dashboards.pull import pull
+from src.cli.dashboards.push import push
+from src.manifest import load_manifest
+from stub_grafana import StubGrafana, serve, pull_args, push_args
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    STUB = StubGrafana(25, PANELS=2, FOLDERS=3)
+    SERVER = serve(STUB)
+    monkeypatch.setenv("GRAFANA_URL", f"http://127.0.0.1:{SERVER.server_port}")
+    monkeypatch.setenv("GRAFANA_APIKEY", "test")
+    # Every test gets its own session, pointed at its own stub
+    dashboards.SESSION = None
+    yield STUB
+    SERVER.shutdown()
+    SERVER.server_close()
+    dashboards.SESSION = None
+
+
+def backed_up(OUTPUT):
+    return sorted(
+        os.path.relpath(os.path.join(ROOT, FILE), OUTPUT)
+        for ROOT, _, FILES in os.walk(OUTPUT)
+        for FILE in FILES
+        if FILE.endswith(".json") and not FILE.startswith(".")
+    )
+
+
+def test_pull_saves_every_dashboard_across_pages(stub, tmp_path):
+    ARGS = pull_args(str(tmp_path), 4)
+    ARGS.page_size = 10
+    pull(ARGS)
+
+    assert stub.requests["search"] == 3
+    assert stub.requests["dashboard"] == 25
+    assert backed_up(str(tmp_path)) == sorted(
+        f"Folder {INDEX % 3}/Dashboard {INDEX}.json" for INDEX in range(25)
+    )
+    with open(tmp_path / "Folder 1" / "Dashboard 4.json") as f:
+        assert json.load(f) == stub.dashboard("stub-000004")
+    MANIFEST = load_manifest(str(tmp_path))
+    assert MANIFEST["stub-000004"]["path"] == "Folder 1/Dashboard 4.json"
+    assert MANIFEST["stub-000004"]["version"] == 1
+
+
+def test_page_size_over_the_search_cap_still_lists_everything(monkeypatch):
+    STUB = StubGrafana(5003, PANELS=0)
+    SERVER = serve(STUB)
+    monkeypatch.setenv("GRAFANA_URL", f"http://127.0.0.1:{SERVER.server_port}")
+    monkeypatch.setenv("GRAFANA_APIKEY", "test")
+    dashboards.SESSION = None
+    try:
+        assert len(list(dashboards.get_dashboards(page_size=10000))) == 5003
+        assert STUB.requests["search"] == 2
+    finally:
+        SERVER.shutdown()
+        SERVER.server_close()
+        dashboards.SESSION = None
+
+
+def test_incremental_pull_only_fetches_changed_dashboards(stub, tmp_path):
+    pull(pull_args(str(tmp_path), 4))
+
+    stub.requests.clear()
+    pull(pull_args(str(tmp_path), 4, True))
+    assert "dashboard" not in stub.requests
+    assert stub.requests["versions"] == 25
+
+    stub.touch("stub-000003")
+    stub.touch("stub-000007")
+    stub.requests.clear()
+    pull(pull_args(str(tmp_path), 4, True))
+    assert stub.requests["dashboard"] == 2
+    assert load_manifest(str(tmp_path))["stub-000003"]["version"] == 2
+
+
+def test_incremental_pull_follows_a_renamed_folder(stub, tmp_path):
+    pull(pull_args(str(tmp_path), 4))
+
+    # Renaming a folder in Grafana leaves the dashboard version alone
+    for DASH in stub.dashboards.values():
+        if DASH["folderUid"] == "folder-2":
+            DASH["folderTitle"] = "Renamed"
+    stub.requests.clear()
+    pull(pull_args(str(tmp_path), 4, True))
+
+    assert stub.requests["dashboard"] == 8
+    assert (tmp_path / "Renamed" / "Dashboard 2.json").exists()
+    assert load_manifest(str(tmp_path))["stub-000002"]["path"] == "Renamed/Dashboard 2.json"
+
+
+def test_pull_forgets_deleted_dashboards(stub, tmp_path):
+    pull(pull_args(str(tmp_path), 4))
+    del stub.dashboards["stub-000005"]
+    pull(pull_args(str(tmp_path), 4, True))
+    assert "stub-000005" not in load_manifest(str(tmp_path))
+
+
+def test_push_after_pull_imports_nothing(stub, tmp_path):
+    pull(pull_args(str(tmp_path), 4))
+
+    stub.requests.clear()
+    push(push_args(str(tmp_path), 4))
+    assert "import" not in stub.requests
+    assert "dashboard" not in stub.requests
+
+
+def test_push_creates_and_updates_changed_files(stub, tmp_path, capsys):
+    pull(pull_args(str(tmp_path), 4))
+
+    PATH = tmp_path / "Folder 0" / "Dashboard 0.json"
+    DASHBOARD = json.loads(PATH.read_text())
+    DASHBOARD["dashboard"]["title"] = "Edited"
+    PATH.write_text(json.dumps(DASHBOARD, indent=2))
+    NEW = json.loads(PATH.read_text())
+    NEW["dashboard"]["uid"] = "new-dashboard"
+    NEW["dashboard"]["title"] = "New"
+    (tmp_path / "Folder 0" / "New.json").write_text(json.dumps(NEW, indent=2))
+
+    stub.requests.clear()
+    push(push_args(str(tmp_path), 4, True))
+    assert "Dry Run: 1 To Create, 1 To Update, 24 Unchanged" in capsys.readouterr().out
+    assert "import" not in stub.requests
+
+    push(push_args(str(tmp_path), 4))
+    assert stub.requests["import"] == 2
+    assert stub.dashboards["stub-000000"]["title"] == "Edited"
+    assert stub.dashboards["stub-000000"]["version"] == 2
+    assert stub.dashboards["new-dashboard"]["title"] == "New"